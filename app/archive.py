@@ -0,0 +1,244 @@
+"""
+Cold-storage archival for old calculations.
+
+Calculations older than ARCHIVE_AFTER_DAYS are moved out of the hot
+`calculations` table into gzip-compressed, column-oriented segment files
+(one directory per user). Archived rows stay readable through
+`find_archived_calculation` and `iter_archived_calculations`, which the
+calculation routes fall back to when a row is missing from the hot table.
+
+Run the job from cron or by hand (it covers every shard when sharding is on):
+
+    python -m app.archive --days 365
+"""
+import argparse
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+from dotenv import load_dotenv
+
+from app.changes import adjust_calculation_counts
+from app.database import SessionLocal, Calculation
+from app.sharding import data_engines
+
+load_dotenv()
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(os.path.dirname(__file__), "..", "archive"))
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "365"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "5000"))
+
+COLUMNS = ("id", "operation", "operand1", "operand2", "result", "user_id", "created_at", "updated_at",
+           "expression", "variables")
+DATETIME_COLUMNS = ("created_at", "updated_at")
+SEGMENT_SUFFIX = ".json.gz"
+
+
+def _user_dir(user_id: int) -> str:
+    return os.path.join(ARCHIVE_DIR, f"user_{user_id}")
+
+
+def _segment_name(min_id: int, max_id: int) -> str:
+    # The id range is encoded in the file name so lookups can skip segments
+    # without opening them.
+    return f"{min_id:012d}-{max_id:012d}{SEGMENT_SUFFIX}"
+
+
+def _list_segments(user_id: int) -> List[Tuple[str, int, int]]:
+    """Return (path, min_id, max_id) for every segment of a user, oldest first"""
+    directory = _user_dir(user_id)
+    if not os.path.isdir(directory):
+        return []
+    segments = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(SEGMENT_SUFFIX):
+            continue
+        min_id, max_id = name[:-len(SEGMENT_SUFFIX)].split("-")
+        segments.append((os.path.join(directory, name), int(min_id), int(max_id)))
+    return segments
+
+
+def _write_segment(user_id: int, rows: list) -> str:
+    """Write rows as a columnar segment; the file is fsynced before returning"""
+    columns: Dict[str, list] = {name: [] for name in COLUMNS}
+    for row in rows:
+        for name in COLUMNS:
+            value = getattr(row, name)
+            if name in DATETIME_COLUMNS and value is not None:
+                value = value.isoformat()
+            columns[name].append(value)
+    return _write_columns(user_id, columns)
+
+
+def _write_columns(user_id: int, columns: Dict[str, list]) -> str:
+    directory = _user_dir(user_id)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, _segment_name(columns["id"][0], columns["id"][-1]))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as gz:
+            gz.write(json.dumps({"columns": columns}, separators=(",", ":")).encode("utf-8"))
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+    return path
+
+
+@lru_cache(maxsize=64)
+def _read_segment(path: str, mtime_ns: int) -> Dict[str, list]:
+    # mtime_ns is part of the cache key so a rewritten segment is re-read
+    with gzip.open(path, "rb") as gz:
+        return json.loads(gz.read().decode("utf-8"))["columns"]
+
+
+def _load_segment(path: str) -> Dict[str, list]:
+    return _read_segment(path, os.stat(path).st_mtime_ns)
+
+
+def _row_at(columns: Dict[str, list], index: int) -> dict:
+    # Segments written before expressions existed lack their columns
+    row = {name: columns[name][index] if name in columns else None for name in COLUMNS}
+    for name in DATETIME_COLUMNS:
+        if row[name] is not None:
+            row[name] = datetime.fromisoformat(row[name])
+    return row
+
+
+def max_archived_id() -> int:
+    """Highest calculation id in any segment, from the segment names"""
+    highest = 0
+    if not os.path.isdir(ARCHIVE_DIR):
+        return highest
+    for name in os.listdir(ARCHIVE_DIR):
+        if name.startswith("user_"):
+            for _, _, max_id in _list_segments(int(name[len("user_"):])):
+                highest = max(highest, max_id)
+    return highest
+
+
+def find_archived_calculation(user_id: int, calculation_id: int) -> Optional[dict]:
+    """Look up a single archived calculation, or None if it is not archived"""
+    for path, min_id, max_id in _list_segments(user_id):
+        if not min_id <= calculation_id <= max_id:
+            continue
+        columns = _load_segment(path)
+        try:
+            index = columns["id"].index(calculation_id)
+        except ValueError:
+            continue
+        return _row_at(columns, index)
+    return None
+
+
+def iter_archived_calculations(user_id: int) -> Iterator[dict]:
+    """Yield every archived calculation of a user in id order"""
+    for path, _, _ in _list_segments(user_id):
+        columns = _load_segment(path)
+        for index in range(len(columns["id"])):
+            yield _row_at(columns, index)
+
+
+def _expired_indexes(columns: Dict[str, list], cutoff: datetime) -> List[int]:
+    # ISO strings of naive UTC timestamps compare in time order
+    cutoff_text = cutoff.isoformat()
+    return [index for index, created_at in enumerate(columns["created_at"])
+            if created_at is not None and created_at < cutoff_text]
+
+
+def find_expired_archived(user_id: int, cutoff: datetime) -> List[int]:
+    """Ids of archived calculations of a user created before the cutoff"""
+    expired = []
+    for path, _, _ in _list_segments(user_id):
+        columns = _load_segment(path)
+        expired.extend(columns["id"][index] for index in _expired_indexes(columns, cutoff))
+    return expired
+
+
+def purge_archived_calculations(user_id: int, cutoff: datetime) -> int:
+    """Drop archived calculations created before the cutoff.
+
+    Segments that become empty are removed; partly expired segments are
+    rewritten under their new id range. Returns the number of purged rows.
+    """
+    purged = 0
+    for path, _, _ in _list_segments(user_id):
+        columns = _load_segment(path)
+        expired = set(_expired_indexes(columns, cutoff))
+        if not expired:
+            continue
+        kept = [index for index in range(len(columns["id"])) if index not in expired]
+        if kept:
+            new_path = _write_columns(user_id, {name: [values[index] for index in kept]
+                                                for name, values in columns.items()})
+            if new_path != path:
+                os.remove(path)
+        else:
+            os.remove(path)
+        purged += len(expired)
+    return purged
+
+
+def archive_calculations(db: Session, older_than_days: Optional[int] = None,
+                         batch_size: Optional[int] = None) -> int:
+    """Move calculations older than the cutoff into cold storage.
+
+    Each batch is deleted with DELETE ... RETURNING and the returned rows are
+    written to disk before the transaction commits, so only rows that were
+    really removed get archived, and a crash leaves rows duplicated (hot rows
+    win on reads) rather than lost. Returns the number of archived
+    calculations.
+    """
+    days = ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    batch_size = batch_size or ARCHIVE_BATCH_SIZE
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    calculations = Calculation.__table__
+    archived = 0
+
+    while True:
+        oldest = select(calculations.c.id).where(
+            calculations.c.created_at < cutoff
+        ).order_by(calculations.c.user_id, calculations.c.id).limit(batch_size)
+        rows = db.execute(
+            delete(calculations).where(calculations.c.id.in_(oldest.scalar_subquery())).returning(*calculations.c)
+        ).all()
+        if not rows:
+            db.commit()
+            break
+
+        by_user: Dict[int, list] = {}
+        for row in sorted(rows, key=lambda row: row.id):
+            by_user.setdefault(row.user_id, []).append(row)
+        for user_id, user_rows in by_user.items():
+            _write_segment(user_id, user_rows)
+
+        adjust_calculation_counts(db, {user_id: -len(user_rows) for user_id, user_rows in by_user.items()})
+        db.commit()
+        archived += len(rows)
+
+    return archived
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive old calculations to cold storage")
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS,
+                        help="archive calculations older than this many days")
+    parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+    args = parser.parse_args()
+
+    count = 0
+    for bind in data_engines():
+        db = SessionLocal(bind=bind)
+        try:
+            count += archive_calculations(db, args.days, args.batch_size)
+        finally:
+            db.close()
+    print(f"Archived {count} calculations older than {args.days} days")
+
+
+if __name__ == "__main__":
+    main()
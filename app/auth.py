@@ -1,21 +1,27 @@
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
+import hashlib
+import hmac
 import os
+import secrets
 from dotenv import load_dotenv
 
-from app.database import get_db, User
+from app.database import get_db, User, RefreshToken
 from app.schemas import TokenData
+from app.sharding import get_shard_router
+from app.tracing import span
 
 load_dotenv()
 
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production-min-32-chars-long")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/token")
@@ -40,6 +46,82 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
+def _hash_refresh_secret(secret: str) -> str:
+    # Refresh secrets are 256-bit random values, so a fast hash is sufficient
+    return hashlib.sha256(secret.encode("utf-8")).hexdigest()
+
+
+def _refresh_token_exception() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid refresh token",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+
+def create_refresh_token(db: Session, user_id: int, family_id: Optional[str] = None) -> str:
+    """Issue a refresh token of the form "<id>.<secret>"; the caller commits"""
+    token_id = secrets.token_hex(16)
+    secret = secrets.token_urlsafe(32)
+    db.add(RefreshToken(
+        id=token_id,
+        user_id=user_id,
+        family_id=family_id or token_id,
+        token_hash=_hash_refresh_secret(secret),
+        expires_at=datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    ))
+    return f"{token_id}.{secret}"
+
+
+def _lookup_refresh_token(db: Session, refresh_token: str) -> Tuple[RefreshToken, User]:
+    token_id, _, secret = refresh_token.partition(".")
+    row = db.query(RefreshToken, User).join(User, User.id == RefreshToken.user_id).filter(
+        RefreshToken.id == token_id
+    ).first()
+    if row is None or not hmac.compare_digest(row[0].token_hash, _hash_refresh_secret(secret)):
+        raise _refresh_token_exception()
+    return row
+
+
+def rotate_refresh_token(db: Session, refresh_token: str) -> Tuple[User, str]:
+    """Exchange a refresh token for its successor.
+
+    Each token can be used once. Presenting an already-rotated token means it
+    was copied, so the whole family descending from that login is revoked.
+    """
+    token, user = _lookup_refresh_token(db, refresh_token)
+    now = datetime.utcnow()
+    if token.expires_at <= now:
+        raise _refresh_token_exception()
+
+    # Conditional update so two concurrent refreshes cannot both succeed
+    rotated = db.query(RefreshToken).filter(
+        RefreshToken.id == token.id,
+        RefreshToken.revoked_at.is_(None)
+    ).update({"revoked_at": now}, synchronize_session=False)
+    if not rotated:
+        db.query(RefreshToken).filter(
+            RefreshToken.family_id == token.family_id,
+            RefreshToken.revoked_at.is_(None)
+        ).update({"revoked_at": now}, synchronize_session=False)
+        db.commit()
+        raise _refresh_token_exception()
+
+    new_token = create_refresh_token(db, user.id, token.family_id)
+    db.commit()
+    return user, new_token
+
+
+def revoke_refresh_token(db: Session, refresh_token: str):
+    """Revoke a refresh token and every token rotated from the same login"""
+    token, _ = _lookup_refresh_token(db, refresh_token)
+    db.query(RefreshToken).filter(
+        RefreshToken.family_id == token.family_id,
+        RefreshToken.revoked_at.is_(None)
+    ).update({"revoked_at": datetime.utcnow()}, synchronize_session=False)
+    db.commit()
+
+
 def authenticate_user(db: Session, username: str, password: str):
     user = db.query(User).filter(User.username == username).first()
     if not user:
@@ -49,7 +131,8 @@ def authenticate_user(db: Session, username: str, password: str):
     return user
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def get_user_from_token(token: str, db: Session) -> User:
+    """Validate a bearer token and return its user, or raise 401"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -63,8 +146,16 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
         token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    
+
+    router = get_shard_router()
+    if router is not None and not router.bind_user(db, token_data.username):
+        raise credentials_exception
     user = db.query(User).filter(User.username == token_data.username).first()
     if user is None:
         raise credentials_exception
     return user
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    with span("auth.get_current_user"):
+        return get_user_from_token(token, db)
@@ -0,0 +1,123 @@
+"""
+Set-based update and delete of calculations selected by a filter.
+
+`PATCH /calculations` and `DELETE /calculations` change every calculation of
+the current user matching a filter (ids, operation, creation date range)
+with one UPDATE or DELETE statement instead of loading rows one by one.
+
+Updates recompute `result` in SQL from the new operation and operands.
+Rows whose new result would divide by zero are left unchanged and reported
+by id, and expression calculations are skipped (their result cannot be
+computed in SQL). Both statements stamp change sequence numbers, write
+tombstones and queue change events like the per-row routes do; archived
+calculations are not affected.
+"""
+from typing import List, Optional
+
+from sqlalchemy import Float, and_, case, delete, false, func, literal, not_, select, update
+from sqlalchemy.orm import Session
+
+from app.changes import record_deletions, reserve_change_seqs
+from app.database import Calculation
+from app.events import calculation_payload, queue_calculation_event
+from app.schemas import CalculationFilter
+
+calculations = Calculation.__table__
+
+ARITHMETIC_OPERATIONS = ("add", "subtract", "multiply", "divide")
+
+
+def filter_criteria(filters: CalculationFilter) -> list:
+    """WHERE conditions for a filter, without the user scope"""
+    conditions = []
+    if filters.ids:
+        conditions.append(calculations.c.id.in_(filters.ids))
+    if filters.operation:
+        conditions.append(calculations.c.operation == filters.operation)
+    if filters.created_from:
+        conditions.append(calculations.c.created_at >= filters.created_from)
+    if filters.created_to:
+        conditions.append(calculations.c.created_at < filters.created_to)
+    return conditions
+
+
+def filter_conditions(user_id: int, filters: CalculationFilter) -> list:
+    return [calculations.c.user_id == user_id, *filter_criteria(filters)]
+
+
+def _apply(operation: str, operand1, operand2):
+    if operation == "add":
+        return operand1 + operand2
+    if operation == "subtract":
+        return operand1 - operand2
+    if operation == "multiply":
+        return operand1 * operand2
+    return operand1 / operand2
+
+
+def update_by_filter(db: Session, user_id: int, filters: CalculationFilter, changes: dict) -> dict:
+    """Apply `changes` (operation/operand1/operand2) to every matching arithmetic calculation.
+
+    Commits and returns the counts for a BulkUpdateResult.
+    """
+    conditions = filter_conditions(user_id, filters)
+    operation: Optional[str] = changes.get("operation")
+    operand1 = literal(changes["operand1"], Float) if "operand1" in changes else calculations.c.operand1
+    operand2 = literal(changes["operand2"], Float) if "operand2" in changes else calculations.c.operand2
+
+    if operation is not None:
+        result = _apply(operation, operand1, operand2)
+        divides_by_zero = operand2 == 0 if operation == "divide" else false()
+    else:
+        result = case(*((calculations.c.operation == name, _apply(name, operand1, operand2))
+                        for name in ARITHMETIC_OPERATIONS))
+        divides_by_zero = and_(calculations.c.operation == "divide", operand2 == 0)
+    arithmetic = calculations.c.operation != "expression"
+
+    # Locks the user's row until commit, so the matched set cannot change underneath
+    reserve_change_seqs(db, user_id, 0)
+    matched, expressions = db.execute(
+        select(func.count(), func.count(case((not_(arithmetic), 1))))
+        .select_from(calculations).where(*conditions)
+    ).one()
+    division_by_zero: List[int] = db.execute(
+        select(calculations.c.id).where(*conditions, arithmetic, divides_by_zero).order_by(calculations.c.id)
+    ).scalars().all()
+
+    updated = matched - expressions - len(division_by_zero)
+    if updated:
+        first = reserve_change_seqs(db, user_id, updated)
+        # Each row gets its own change sequence number, in id order
+        ranked = (
+            select(calculations.c.id, func.row_number().over(order_by=calculations.c.id).label("position"))
+            .where(*conditions, arithmetic, not_(divides_by_zero))
+            .subquery()
+        )
+        values = {"result": result, "change_seq": ranked.c.position + (first - 1)}
+        if operation is not None:
+            values["operation"] = operation
+        if "operand1" in changes:
+            values["operand1"] = operand1
+        if "operand2" in changes:
+            values["operand2"] = operand2
+        rows = db.execute(
+            update(calculations).where(calculations.c.id == ranked.c.id).values(values)
+            .returning(*calculations.c)
+        ).all()
+        for row in rows:
+            queue_calculation_event(db, user_id, {"type": "updated", "data": calculation_payload(row)})
+    db.commit()
+    return {"matched": matched, "updated": updated, "division_by_zero": division_by_zero,
+            "skipped_expressions": expressions}
+
+
+def delete_by_filter(db: Session, user_id: int, filters: CalculationFilter) -> int:
+    """Delete every matching calculation; commits and returns the number deleted"""
+    ids = db.execute(
+        delete(calculations).where(*filter_conditions(user_id, filters)).returning(calculations.c.id)
+    ).scalars().all()
+    record_deletions(db, user_id, ids)
+    for calculation_id in ids:
+        queue_calculation_event(db, user_id, {"type": "deleted", "data": {"id": calculation_id}})
+    db.commit()
+    return len(ids)
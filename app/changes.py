@@ -0,0 +1,131 @@
+"""
+Change tracking for delta sync.
+
+Every user has a monotonically increasing change sequence (`users.change_seq`).
+Each inserted or updated calculation is stamped with the next value, and each
+deleted calculation leaves a tombstone carrying one, so
+`GET /calculations/changes?since=<token>` can return exactly the rows that
+changed after a checkpoint with an indexed range scan on
+(user_id, change_seq).
+
+The same statements keep `users.calculation_count`, the number of the
+user's rows in `calculations`, so pagination totals need no COUNT(*).
+
+ORM writes are stamped automatically by a flush hook. Set-based statements
+that bypass the ORM must call `reserve_change_seqs` / `record_deletions`
+(and `adjust_calculation_counts` when they remove rows without tombstones).
+"""
+from typing import Dict, List
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from app.database import User, Calculation, CalculationTombstone
+
+users_table = User.__table__
+
+
+def reserve_change_seqs(session: Session, user_id: int, count: int, count_delta: int = 0) -> int:
+    """Reserve `count` change sequence numbers for a user; returns the first one.
+
+    The increment locks the user's row until commit, so sequence numbers are
+    issued in commit order for that user. `count_delta` is added to the
+    user's calculation_count in the same statement.
+    """
+    values = {"change_seq": users_table.c.change_seq + count}
+    if count_delta:
+        values["calculation_count"] = users_table.c.calculation_count + count_delta
+    connection = session.connection()
+    last = connection.execute(
+        users_table.update()
+        .where(users_table.c.id == user_id)
+        .values(values)
+        .returning(users_table.c.change_seq)
+    ).scalar_one()
+    return last - count + 1
+
+
+def adjust_calculation_counts(session: Session, deltas: Dict[int, int]):
+    """Add per-user deltas to calculation_count"""
+    connection = session.connection()
+    for user_id, delta in deltas.items():
+        if delta:
+            connection.execute(
+                users_table.update()
+                .where(users_table.c.id == user_id)
+                .values(calculation_count=users_table.c.calculation_count + delta)
+            )
+
+
+def record_deletions(session: Session, user_id: int, calculation_ids: List[int], counted: bool = True):
+    """Write tombstones for calculations removed with set-based statements.
+
+    `counted` is False for rows that were no longer in `calculations` (e.g.
+    archived copies), which calculation_count does not include.
+    """
+    if not calculation_ids:
+        return
+    first = reserve_change_seqs(session, user_id, len(calculation_ids),
+                                -len(calculation_ids) if counted else 0)
+    session.connection().execute(
+        CalculationTombstone.__table__.insert(),
+        [
+            {"calculation_id": calculation_id, "user_id": user_id, "change_seq": first + offset}
+            for offset, calculation_id in enumerate(calculation_ids)
+        ]
+    )
+
+
+@event.listens_for(Session, "before_flush")
+def _stamp_calculation_changes(session, flush_context, instances):
+    changed: Dict[int, List[Calculation]] = {}
+    added: Dict[int, int] = {}
+    for obj in session.new:
+        if isinstance(obj, Calculation):
+            changed.setdefault(obj.user_id, []).append(obj)
+            added[obj.user_id] = added.get(obj.user_id, 0) + 1
+    for obj in session.dirty:
+        if isinstance(obj, Calculation) and session.is_modified(obj):
+            changed.setdefault(obj.user_id, []).append(obj)
+    deleted: Dict[int, List[Calculation]] = {}
+    for obj in session.deleted:
+        if isinstance(obj, Calculation):
+            deleted.setdefault(obj.user_id, []).append(obj)
+
+    for user_id in changed.keys() | deleted.keys():
+        rows = changed.get(user_id, [])
+        removed = deleted.get(user_id, [])
+        seq = reserve_change_seqs(session, user_id, len(rows) + len(removed),
+                                  added.get(user_id, 0) - len(removed))
+        for obj in rows:
+            obj.change_seq = seq
+            seq += 1
+        for obj in removed:
+            session.add(CalculationTombstone(calculation_id=obj.id, user_id=user_id, change_seq=seq))
+            seq += 1
+
+
+def get_changes_since(session: Session, user_id: int, since: int, limit: int):
+    """Return (changed calculations, deleted ids, next checkpoint, has_more)"""
+    rows = session.query(Calculation).filter(
+        Calculation.user_id == user_id,
+        Calculation.change_seq > since
+    ).order_by(Calculation.change_seq).limit(limit + 1).all()
+    tombstones = session.execute(
+        select(CalculationTombstone.calculation_id, CalculationTombstone.change_seq)
+        .where(CalculationTombstone.user_id == user_id, CalculationTombstone.change_seq > since)
+        .order_by(CalculationTombstone.change_seq)
+        .limit(limit + 1)
+    ).all()
+
+    merged = sorted(
+        [(row.change_seq, row) for row in rows] + [(seq, calculation_id) for calculation_id, seq in tombstones],
+        key=lambda entry: entry[0]
+    )
+    has_more = len(merged) > limit
+    merged = merged[:limit]
+
+    changes = [entry for _, entry in merged if isinstance(entry, Calculation)]
+    deleted = [entry for _, entry in merged if not isinstance(entry, Calculation)]
+    checkpoint = merged[-1][0] if merged else since
+    return changes, deleted, checkpoint, has_more
@@ -0,0 +1,204 @@
+"""
+Per-user change events for calculations.
+
+Every committed insert, update or delete of a `Calculation` is published to
+the owner's subscribers, whichever code path made it (routes, group commit,
+jobs, WebSocket). Events are collected from the ORM flush and only published
+once the transaction commits.
+
+The default broker fans events out to subscribers in this process. With
+several workers set EVENTS_BACKEND=postgres so events travel through
+Postgres LISTEN/NOTIFY and reach subscribers connected to any worker.
+"""
+import asyncio
+import json
+import os
+import select
+import threading
+import time
+from typing import Dict, Optional, Set
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+from dotenv import load_dotenv
+
+from app.database import DATABASE_URL, Calculation
+from app.schemas import CalculationResponse
+
+load_dotenv()
+
+EVENTS_BACKEND = os.getenv("EVENTS_BACKEND", "memory")  # memory or postgres
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "100"))
+
+
+class Subscription:
+    """Bounded event queue of one connected client"""
+
+    def __init__(self, user_id: int, maxsize: int):
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+
+    def deliver(self, event: dict):
+        # Runs on the subscriber's event loop. A client that cannot keep up
+        # loses its backlog and is told to reload instead of blocking publishers.
+        if self.queue.full():
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait({"type": "resync", "data": {}})
+            return
+        self.queue.put_nowait(event)
+
+    async def get(self) -> dict:
+        return await self.queue.get()
+
+
+class InProcessBroker:
+    """Fan-out of events to subscribers connected to this process"""
+
+    def __init__(self, maxsize: int = EVENT_QUEUE_SIZE):
+        self._maxsize = maxsize
+        self._subscriptions: Dict[int, Set[Subscription]] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id: int) -> Subscription:
+        """Register a subscriber; must be called from the subscriber's event loop"""
+        subscription = Subscription(user_id, self._maxsize)
+        with self._lock:
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+    def publish(self, user_id: int, event: dict):
+        """Publish an event to a user's subscribers; safe to call from any thread"""
+        self.dispatch(user_id, event)
+
+    def dispatch(self, user_id: int, event: dict):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, event)
+            except RuntimeError:
+                # Event loop already closed; the subscriber is gone
+                self.unsubscribe(subscription)
+
+
+class PostgresNotifyBroker(InProcessBroker):
+    """Broker shared by several workers through Postgres LISTEN/NOTIFY"""
+
+    channel = "calculation_events"
+
+    def __init__(self, database_url: str, maxsize: int = EVENT_QUEUE_SIZE):
+        super().__init__(maxsize)
+        self._dsn = make_url(database_url).set(drivername="postgresql").render_as_string(hide_password=False)
+        self._publish_connection = None
+        self._publish_lock = threading.Lock()
+        self._listener = threading.Thread(target=self._listen, name="event-listener", daemon=True)
+        self._listener.start()
+
+    def _connect(self):
+        import psycopg2
+
+        connection = psycopg2.connect(self._dsn)
+        connection.autocommit = True
+        return connection
+
+    def publish(self, user_id: int, event: dict):
+        # Delivered locally by our own listener, like every other worker's
+        payload = json.dumps({"user_id": user_id, "event": event})
+        with self._publish_lock:
+            if self._publish_connection is None or self._publish_connection.closed:
+                self._publish_connection = self._connect()
+            with self._publish_connection.cursor() as cursor:
+                cursor.execute("SELECT pg_notify(%s, %s)", (self.channel, payload))
+
+    def _listen(self):
+        while True:
+            try:
+                connection = self._connect()
+                with connection.cursor() as cursor:
+                    cursor.execute(f"LISTEN {self.channel}")
+                while True:
+                    if select.select([connection], [], [], 5) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        notification = connection.notifies.pop(0)
+                        message = json.loads(notification.payload)
+                        self.dispatch(message["user_id"], message["event"])
+            except Exception:
+                time.sleep(1)
+
+
+_broker: Optional[InProcessBroker] = None
+_broker_lock = threading.Lock()
+
+
+def get_event_broker() -> InProcessBroker:
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            if EVENTS_BACKEND == "postgres":
+                _broker = PostgresNotifyBroker(DATABASE_URL)
+            else:
+                _broker = InProcessBroker()
+        return _broker
+
+
+def set_event_broker(broker: InProcessBroker):
+    """Replace the broker, e.g. with a custom backend"""
+    global _broker
+    with _broker_lock:
+        _broker = broker
+
+
+def calculation_payload(calculation: Calculation) -> dict:
+    return CalculationResponse.model_validate(calculation).model_dump(mode="json")
+
+
+def queue_calculation_event(session: Session, user_id: int, calculation_event: dict):
+    """Publish an event after commit for changes made with set-based statements"""
+    session.info.setdefault("calculation_events", []).append((user_id, calculation_event))
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_calculation_events(session, flush_context):
+    # new/dirty/deleted still describe the flushed changes at this point
+    pending = session.info.setdefault("calculation_events", [])
+    for obj in session.new:
+        if isinstance(obj, Calculation):
+            pending.append((obj.user_id, {"type": "created", "data": calculation_payload(obj)}))
+    for obj in session.dirty:
+        if isinstance(obj, Calculation) and session.is_modified(obj):
+            pending.append((obj.user_id, {"type": "updated", "data": calculation_payload(obj)}))
+    for obj in session.deleted:
+        if isinstance(obj, Calculation):
+            pending.append((obj.user_id, {"type": "deleted", "data": {"id": obj.id}}))
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_calculation_events(session):
+    pending = session.info.pop("calculation_events", None)
+    if not pending:
+        return
+    broker = get_event_broker()
+    for user_id, calculation_event in pending:
+        try:
+            broker.publish(user_id, calculation_event)
+        except Exception:
+            # Notifications are best effort; the data is already committed
+            pass
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_calculation_events(session):
+    session.info.pop("calculation_events", None)
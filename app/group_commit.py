@@ -0,0 +1,154 @@
+"""
+Group-commit write buffer for calculation inserts.
+
+When GROUP_COMMIT_ENABLED is set, `create_calculation` hands its row to a
+background writer instead of committing on its own. The writer collects
+inserts for up to GROUP_COMMIT_MAX_DELAY_MS (or GROUP_COMMIT_MAX_BATCH rows)
+and commits them in a single transaction, so many requests share one fsync.
+Callers block until their batch is committed, so a 201 is only ever returned
+for a durable row. The wait is bounded by the request deadline; a row whose
+caller gave up is withdrawn from the queue if its batch has not started, and
+the caller gets a 503 either way.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+from dotenv import load_dotenv
+
+from app.database import Calculation
+from app.resilience import DeadlineExceeded, remaining_time
+
+load_dotenv()
+
+GROUP_COMMIT_ENABLED = os.getenv("GROUP_COMMIT_ENABLED", "false").lower() == "true"
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "100"))
+GROUP_COMMIT_MAX_DELAY_MS = float(os.getenv("GROUP_COMMIT_MAX_DELAY_MS", "2"))
+GROUP_COMMIT_TIMEOUT_SECONDS = float(os.getenv("GROUP_COMMIT_TIMEOUT_SECONDS", "30"))
+
+_STOP = object()
+
+
+def _row_values(row: Calculation) -> dict:
+    return {column.key: getattr(row, column.key) for column in Calculation.__table__.columns}
+
+
+class GroupCommitWriter:
+    """Single background thread that batches calculation inserts per engine"""
+
+    def __init__(self, bind: Engine, max_batch: int = GROUP_COMMIT_MAX_BATCH,
+                 max_delay_ms: float = GROUP_COMMIT_MAX_DELAY_MS):
+        self._session_factory = sessionmaker(autocommit=False, autoflush=False, bind=bind)
+        self._max_batch = max_batch
+        self._max_delay = max_delay_ms / 1000.0
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="group-commit-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, values: dict) -> Future:
+        """Enqueue a calculation insert; the future resolves to the committed row"""
+        future: Future = Future()
+        self._queue.put((values, future))
+        return future
+
+    def insert(self, values: dict, timeout: Optional[float] = GROUP_COMMIT_TIMEOUT_SECONDS) -> dict:
+        """Insert a calculation and block until its batch has been committed.
+
+        Raises DeadlineExceeded when the timeout or the request deadline runs
+        out first; the row is dropped unless its batch was already committing.
+        """
+        remaining = remaining_time()
+        if remaining is not None:
+            timeout = max(0.0, remaining) if timeout is None else max(0.0, min(timeout, remaining))
+        future = self.submit(values)
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise DeadlineExceeded("group commit did not finish in time")
+
+    def stop(self):
+        """Flush everything already queued, then stop the writer thread"""
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self._max_delay
+            while len(batch) < self._max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+
+    def _flush(self, batch: List[Tuple[dict, Future]]):
+        # Rows whose callers timed out are skipped; the rest can no longer be cancelled
+        batch = [(values, future) for values, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            results = self._commit([values for values, _ in batch])
+        except Exception:
+            # One bad row must not fail the whole group: retry individually
+            # so each caller gets its own outcome.
+            for values, future in batch:
+                try:
+                    future.set_result(self._commit([values])[0])
+                except Exception as exc:
+                    future.set_exception(exc)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def _commit(self, rows: List[dict]) -> List[dict]:
+        session = self._session_factory()
+        try:
+            calculations = [Calculation(**values) for values in rows]
+            session.add_all(calculations)
+            session.flush()
+            results = [_row_values(calculation) for calculation in calculations]
+            session.commit()
+            return results
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+
+_writers: Dict[Engine, GroupCommitWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def get_group_commit_writer(bind: Engine) -> GroupCommitWriter:
+    """Return the writer for an engine, starting it on first use"""
+    with _writers_lock:
+        writer = _writers.get(bind)
+        if writer is None:
+            writer = _writers[bind] = GroupCommitWriter(bind)
+        return writer
+
+
+def stop_group_commit_writers():
+    """Drain and stop all writers (called on application shutdown)"""
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        writer.stop()
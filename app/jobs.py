@@ -0,0 +1,224 @@
+"""
+Background processing of large calculation batches.
+
+Jobs are stored in the `calculation_jobs` table together with their payload,
+so nothing is lost on restart and no external broker is needed. A local
+thread pool works through each job in chunks of JOB_CHUNK_SIZE; every chunk
+inserts its calculations and advances `processed` in the same transaction,
+which makes the progress counter a restart checkpoint. Per-item outcomes are
+appended to an NDJSON results file under JOB_RESULTS_DIR.
+
+Several API processes may share one database. A runner claims a job with a
+conditional UPDATE that only succeeds while the job is pending or its lease
+has expired, and renews the lease (JOB_LEASE_SECONDS) with every chunk, so
+each job is executed by exactly one runner at a time. On startup only
+pending jobs and jobs whose owner stopped renewing are resumed.
+"""
+import json
+import os
+import socket
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from fastapi import HTTPException
+from pydantic import ValidationError
+from sqlalchemy import and_, or_, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+from dotenv import load_dotenv
+
+from app.database import Calculation, CalculationJob
+from app.schemas import CalculationCreate
+from app.routes.calculation_routes import calculation_values
+
+load_dotenv()
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_CHUNK_SIZE = int(os.getenv("JOB_CHUNK_SIZE", "500"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "60"))  # must exceed the time of one chunk
+JOB_RESULTS_DIR = os.getenv("JOB_RESULTS_DIR", os.path.join(os.path.dirname(__file__), "..", "job_results"))
+
+
+def _results_path(job_id: int) -> str:
+    return os.path.join(JOB_RESULTS_DIR, f"job_{job_id}.ndjson")
+
+
+def _truncate_results(path: str, lines: int):
+    """Drop result lines written after the last committed checkpoint"""
+    if not os.path.exists(path):
+        return
+    with open(path, "r+", encoding="utf-8") as results:
+        for _ in range(lines):
+            if not results.readline():
+                break
+        results.truncate(results.tell())
+
+
+def _evaluate(item: dict):
+    """Validate one job item; returns (values, None) or (None, error message)"""
+    try:
+        calculation = CalculationCreate.model_validate(item)
+        values = calculation_values(calculation)
+    except ValidationError as exc:
+        return None, "; ".join(error["msg"] for error in exc.errors())
+    except HTTPException as exc:
+        return None, exc.detail
+    return values, None
+
+
+class LeaseLost(Exception):
+    pass
+
+
+jobs_table = CalculationJob.__table__
+
+
+def _claimable(now: datetime):
+    # Pending, or running under a lease that has lapsed (or predates leases)
+    return or_(
+        jobs_table.c.status == "pending",
+        and_(jobs_table.c.status == "running",
+             or_(jobs_table.c.lease_until.is_(None), jobs_table.c.lease_until < now))
+    )
+
+
+class JobRunner:
+    """Thread pool that executes calculation jobs stored in one database"""
+
+    def __init__(self, bind: Engine, workers: int = JOB_WORKERS, chunk_size: int = JOB_CHUNK_SIZE,
+                 lease_seconds: int = JOB_LEASE_SECONDS):
+        self._session_factory = sessionmaker(autocommit=False, autoflush=False, bind=bind)
+        self._chunk_size = chunk_size
+        self._lease = timedelta(seconds=lease_seconds)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="calculation-job")
+        self._stopping = threading.Event()
+
+    def enqueue(self, job_id: int) -> Future:
+        return self._executor.submit(self._run_job, job_id)
+
+    def resume_pending(self) -> int:
+        """Re-enqueue jobs that are pending or whose runner stopped renewing its lease"""
+        session = self._session_factory()
+        try:
+            job_ids = [job_id for (job_id,) in session.query(CalculationJob.id).filter(
+                _claimable(datetime.utcnow())
+            ).order_by(CalculationJob.id)]
+        finally:
+            session.close()
+        for job_id in job_ids:
+            self.enqueue(job_id)
+        return len(job_ids)
+
+    def stop(self, wait: bool = True):
+        """Stop at the next chunk boundary; unfinished jobs resume on next start"""
+        self._stopping.set()
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _claim(self, session, job_id: int) -> bool:
+        now = datetime.utcnow()
+        claimed = session.execute(
+            update(jobs_table).where(jobs_table.c.id == job_id, _claimable(now))
+            .values(status="running", owner=self.owner, lease_until=now + self._lease,
+                    results_path=_results_path(job_id))
+        ).rowcount
+        session.commit()
+        return claimed == 1
+
+    def _renew(self, session, job_id: int, **values):
+        """Extend the lease inside the current transaction; raises LeaseLost if another runner took over"""
+        renewed = session.execute(
+            update(jobs_table).where(jobs_table.c.id == job_id, jobs_table.c.owner == self.owner)
+            .values(**{"lease_until": datetime.utcnow() + self._lease, **values})
+        ).rowcount
+        if renewed != 1:
+            raise LeaseLost(job_id)
+
+    def _run_job(self, job_id: int):
+        session = self._session_factory()
+        try:
+            if not self._claim(session, job_id):
+                return  # finished, or running elsewhere
+            job = session.get(CalculationJob, job_id)
+
+            items: List[dict] = json.loads(job.payload)
+            os.makedirs(JOB_RESULTS_DIR, exist_ok=True)
+            _truncate_results(job.results_path, job.processed)
+
+            with open(job.results_path, "a", encoding="utf-8") as results:
+                for start in range(job.processed, len(items), self._chunk_size):
+                    if self._stopping.is_set():
+                        # Hand the job back so the next start does not wait for the lease
+                        self._renew(session, job_id, status="pending", owner=None, lease_until=None)
+                        session.commit()
+                        return
+                    self._process_chunk(session, job, items, start, results)
+
+            self._renew(session, job_id, status="completed", lease_until=None)
+            session.commit()
+        except LeaseLost:
+            session.rollback()
+        except Exception as exc:
+            session.rollback()
+            session.execute(
+                update(jobs_table).where(jobs_table.c.id == job_id, jobs_table.c.owner == self.owner)
+                .values(status="failed", error=str(exc), lease_until=None)
+            )
+            session.commit()
+        finally:
+            session.close()
+
+    def _process_chunk(self, session, job: CalculationJob, items: List[dict], start: int, results):
+        # Renewing first locks the job row, so no one can claim it before this chunk commits
+        self._renew(session, job.id)
+        chunk = items[start:start + self._chunk_size]
+        outcomes = []
+        rows = []
+        for item in chunk:
+            values, error = _evaluate(item)
+            if error is not None:
+                outcomes.append({"error": error})
+                continue
+            row = Calculation(user_id=job.user_id, **values)
+            rows.append(row)
+            outcomes.append({"row": row})
+        session.add_all(rows)
+        session.flush()
+
+        for offset, outcome in enumerate(outcomes):
+            line = {"index": start + offset}
+            if "row" in outcome:
+                line.update(id=outcome["row"].id, result=outcome["row"].result)
+            else:
+                line["error"] = outcome["error"]
+            results.write(json.dumps(line) + "\n")
+        results.flush()
+        os.fsync(results.fileno())
+
+        job.processed = start + len(chunk)
+        job.failed += sum(1 for outcome in outcomes if "error" in outcome)
+        session.commit()
+
+
+_runners: Dict[Engine, JobRunner] = {}
+_runners_lock = threading.Lock()
+
+
+def get_job_runner(bind: Engine) -> JobRunner:
+    """Return the job runner for an engine, starting it on first use"""
+    with _runners_lock:
+        runner = _runners.get(bind)
+        if runner is None:
+            runner = _runners[bind] = JobRunner(bind)
+        return runner
+
+
+def stop_job_runners(wait: bool = True):
+    with _runners_lock:
+        runners = list(_runners.values())
+        _runners.clear()
+    for runner in runners:
+        runner.stop(wait)
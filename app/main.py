@@ -1,11 +1,22 @@
-from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, Request, status
+from fastapi.responses import JSONResponse
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeoutError
 from fastapi.middleware.cors import CORSMiddleware
 import os
 
-from app.database import init_db
-from app.routes import auth_routes, calculation_routes
+from app.compression import CompressionMiddleware, COMPRESSION_MINIMUM_SIZE
+from app.database import init_db, engine
+from app.group_commit import stop_group_commit_writers
+from app.jobs import get_job_runner, stop_job_runners
+from app.profiling import ProfilingMiddleware, profiling_enabled
+from app.resilience import (
+    CircuitOpen, DeadlineExceeded, DeadlineMiddleware, database_unavailable, readiness
+)
+from app.retention import start_retention_worker, stop_retention_worker
+from app.routes import auth_routes, calculation_routes, job_routes
+from app.sharding import data_engines, get_shard_router
+from app import tracing
+from app.static_assets import StaticAssetCache, CachedStaticFiles
 
 app = FastAPI(
     title="Calculations API",
@@ -20,28 +31,70 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Total-Count", "X-Total-Count-Approximate"],
 )
 
+# Compress responses above the threshold with brotli or gzip
+app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MINIMUM_SIZE)
+
+# Opt-in request profiling (PROFILE_TOKEN / PROFILE_SAMPLE_RATE)
+if profiling_enabled():
+    app.add_middleware(ProfilingMiddleware)
+
+# Request tracing with a local span exporter (TRACING_ENABLED)
+if tracing.TRACING_ENABLED:
+    tracing.install()
+    app.add_middleware(tracing.TracingMiddleware)
+
+# Per-request deadline, enforced as statement timeouts (REQUEST_DEADLINE_MS)
+app.add_middleware(DeadlineMiddleware)
+
+# Database outages, deadlines and an open circuit breaker answer 503
+for database_error in (CircuitOpen, DeadlineExceeded, OperationalError, PoolTimeoutError):
+    app.add_exception_handler(database_error, database_unavailable)
+
 # Initialize database
 @app.on_event("startup")
 def startup_event():
-    init_db()
+    shard_router = get_shard_router()
+    if shard_router is not None:
+        # App tables live on the shards; the directory only gets its own tables
+        shard_router.create_all()
+    else:
+        init_db()
+    if static_assets is not None:
+        static_assets.load()
+    for bind in data_engines():
+        # Pick up jobs interrupted by the previous shutdown
+        get_job_runner(bind).resume_pending()
+        # Periodic retention purge, if RETENTION_INTERVAL_SECONDS is set
+        start_retention_worker(bind)
+
+@app.on_event("shutdown")
+def shutdown_event():
+    stop_group_commit_writers()
+    stop_job_runners()
+    stop_retention_worker()
 
 # Include routers
 app.include_router(auth_routes.router)
+# Job routes are registered first so /calculations/jobs is not captured by /calculations/{id}
+app.include_router(job_routes.router)
 app.include_router(calculation_routes.router)
 
-# Mount static files
+# Mount static files (small assets are served from an in-memory cache)
 static_dir = os.path.join(os.path.dirname(__file__), "..", "static")
-if os.path.exists(static_dir):
-    app.mount("/static", StaticFiles(directory=static_dir), name="static")
+static_assets = StaticAssetCache(static_dir) if os.path.isdir(static_dir) else None
+if static_assets is not None:
+    app.mount("/static", CachedStaticFiles(static_assets), name="static")
 
 # Root endpoint
 @app.get("/")
-def read_root():
-    static_index = os.path.join(static_dir, "index.html")
-    if os.path.exists(static_index):
-        return FileResponse(static_index)
+def read_root(request: Request):
+    if static_assets is not None:
+        static_assets.ensure_loaded()
+        if static_assets.index is not None:
+            return static_assets.index.response(request.headers)
     return {
         "message": "Calculations API",
         "docs": "/docs",
@@ -55,3 +108,16 @@ def read_root():
 @app.get("/health")
 def health_check():
     return {"status": "healthy"}
+
+# Readiness: circuit breaker, pool and a probe query for every database
+@app.get("/health/ready")
+def readiness_check():
+    # Probes the engines themselves rather than a request session
+    shard_router = get_shard_router()
+    if shard_router is not None:
+        binds = [*shard_router.engines.values(), shard_router.directory_engine]
+    else:
+        binds = [engine]
+    ready, report = readiness(binds)
+    return JSONResponse(status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE,
+                        content=report)
@@ -0,0 +1,205 @@
+"""
+Schema migrations for existing databases.
+
+`Base.metadata.create_all` only creates missing tables, so databases created
+by earlier versions need these steps to reach the current layout:
+
+- `users.change_seq` for delta sync
+- the compact `calculations` layout: SMALLINT operation codes, server-side
+  UTC timestamp defaults, alignment-ordered columns, `change_seq`, and no
+  redundant index on the primary key
+- the `(user_id, created_at)` index used by archival and retention
+- `expression`/`variables` columns and nullable operands for expressions
+- `users.calculation_count`, backfilled from the calculations table
+- `calculation_jobs.owner`/`lease_until` for claiming jobs
+- AUTOINCREMENT ids for `calculations` on SQLite, so ids of archived rows
+  are never reused
+
+The calculations table is rebuilt (copy into the new layout, then swap) in a
+single transaction, which both SQLite and Postgres need for a column type
+change anyway. Every step checks the current schema first, so running the
+migration twice is harmless.
+
+    python -m app.migrations
+"""
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+
+from app.archive import max_archived_id
+from app.database import engine as default_engine, Base, Calculation, OPERATION_CODES
+
+CALCULATION_COLUMNS = ("id", "user_id", "operand1", "operand2", "result",
+                       "created_at", "updated_at", "change_seq", "operation")
+
+
+def _column_names(inspector, table: str) -> set:
+    return {column["name"] for column in inspector.get_columns(table)}
+
+
+def add_user_change_seq(connection) -> bool:
+    inspector = inspect(connection)
+    if "change_seq" in _column_names(inspector, "users"):
+        return False
+    connection.execute(text("ALTER TABLE users ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0"))
+    return True
+
+
+def _rebuild_calculations(connection, inspector, select_sql: str, columns=CALCULATION_COLUMNS):
+    """Recreate `calculations` from the current model, copying `columns` with `select_sql`"""
+    # Move the old table aside; its indexes keep their names, so drop them
+    # before the new table creates its own.
+    indexes = [index["name"] for index in inspector.get_indexes("calculations")]
+    connection.execute(text("ALTER TABLE calculations RENAME TO calculations_legacy"))
+    for name in indexes:
+        connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("ALTER INDEX IF EXISTS calculations_pkey RENAME TO calculations_legacy_pkey"))
+    Calculation.__table__.create(connection)
+
+    connection.execute(text(f"INSERT INTO calculations ({', '.join(columns)}) {select_sql}"))
+    connection.execute(text("DROP TABLE calculations_legacy"))
+
+    if connection.dialect.name == "postgresql":
+        # The new SERIAL sequence starts at 1; continue after the copied ids
+        connection.execute(text(
+            "SELECT setval(pg_get_serial_sequence('calculations', 'id'), "
+            "COALESCE((SELECT MAX(id) FROM calculations), 0) + 1, false)"
+        ))
+
+
+def compact_calculations(connection) -> bool:
+    """Rebuild `calculations` in the compact layout if it still stores names"""
+    inspector = inspect(connection)
+    if "calculations" not in inspector.get_table_names():
+        return False
+    columns = {column["name"]: column for column in inspector.get_columns("calculations")}
+    if columns["operation"]["type"].python_type is int:
+        return False
+
+    operation_code = "CASE operation " + " ".join(
+        f"WHEN '{name}' THEN {code}" for name, code in OPERATION_CODES.items()
+    ) + " END"
+    change_seq = "change_seq" if "change_seq" in columns else "0"
+    _rebuild_calculations(connection, inspector, (
+        f"SELECT id, user_id, operand1, operand2, result, "
+        f"COALESCE(created_at, CURRENT_TIMESTAMP), "
+        f"COALESCE(updated_at, created_at, CURRENT_TIMESTAMP), "
+        f"{change_seq}, {operation_code} "
+        f"FROM calculations_legacy"
+    ))
+    return True
+
+
+def add_expression_columns(connection) -> bool:
+    """Add `expression`/`variables`, make operands nullable and allow operation code 5"""
+    inspector = inspect(connection)
+    if "calculations" not in inspector.get_table_names():
+        return False
+    if "expression" in _column_names(inspector, "calculations"):
+        return False
+    if connection.dialect.name == "postgresql":
+        for statement in (
+            "ALTER TABLE calculations ADD COLUMN expression TEXT",
+            "ALTER TABLE calculations ADD COLUMN variables JSON",
+            "ALTER TABLE calculations ALTER COLUMN operand1 DROP NOT NULL",
+            "ALTER TABLE calculations ALTER COLUMN operand2 DROP NOT NULL",
+            "ALTER TABLE calculations DROP CONSTRAINT IF EXISTS ck_calculations_operation",
+            "ALTER TABLE calculations ADD CONSTRAINT ck_calculations_operation CHECK (operation BETWEEN 1 AND 5)",
+        ):
+            connection.execute(text(statement))
+        return True
+    # SQLite cannot relax NOT NULL or CHECK constraints in place
+    _rebuild_calculations(connection, inspector,
+                          f"SELECT {', '.join(CALCULATION_COLUMNS)} FROM calculations_legacy")
+    return True
+
+
+def add_created_at_index(connection) -> bool:
+    inspector = inspect(connection)
+    if "calculations" not in inspector.get_table_names():
+        return False
+    if any(index["name"] == "ix_calculations_user_id_created_at" for index in inspector.get_indexes("calculations")):
+        return False
+    connection.execute(text("CREATE INDEX ix_calculations_user_id_created_at ON calculations (user_id, created_at)"))
+    return True
+
+
+def add_user_calculation_count(connection) -> bool:
+    inspector = inspect(connection)
+    if "calculation_count" in _column_names(inspector, "users"):
+        return False
+    connection.execute(text("ALTER TABLE users ADD COLUMN calculation_count INTEGER NOT NULL DEFAULT 0"))
+    if "calculations" in inspector.get_table_names():
+        connection.execute(text(
+            "UPDATE users SET calculation_count = "
+            "(SELECT COUNT(*) FROM calculations WHERE calculations.user_id = users.id)"
+        ))
+    return True
+
+
+def add_job_lease_columns(connection) -> bool:
+    inspector = inspect(connection)
+    if "calculation_jobs" not in inspector.get_table_names():
+        return False
+    if "owner" in _column_names(inspector, "calculation_jobs"):
+        return False
+    timestamp = "TIMESTAMP" if connection.dialect.name == "postgresql" else "DATETIME"
+    connection.execute(text("ALTER TABLE calculation_jobs ADD COLUMN owner VARCHAR"))
+    connection.execute(text(f"ALTER TABLE calculation_jobs ADD COLUMN lease_until {timestamp}"))
+    return True
+
+
+def autoincrement_calculation_ids(connection) -> bool:
+    """Rebuild `calculations` with AUTOINCREMENT on SQLite and start its sequence past archived ids"""
+    if connection.dialect.name != "sqlite":
+        return False  # SERIAL sequences never hand out an id twice
+    inspector = inspect(connection)
+    if "calculations" not in inspector.get_table_names():
+        return False
+    applied = False
+    table_sql = connection.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'calculations'")
+    ).scalar()
+    if "AUTOINCREMENT" not in table_sql.upper():
+        columns = CALCULATION_COLUMNS + ("expression", "variables")
+        _rebuild_calculations(connection, inspector,
+                              f"SELECT {', '.join(columns)} FROM calculations_legacy", columns)
+        applied = True
+    current = connection.execute(
+        text("SELECT seq FROM sqlite_sequence WHERE name = 'calculations'")
+    ).scalar() or 0
+    highest = max(connection.execute(text("SELECT MAX(id) FROM calculations")).scalar() or 0, max_archived_id())
+    if highest > current:
+        connection.execute(text("DELETE FROM sqlite_sequence WHERE name = 'calculations'"))
+        connection.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('calculations', :seq)"),
+                           {"seq": highest})
+        applied = True
+    return applied
+
+
+def migrate(bind: Engine = default_engine) -> list:
+    """Bring a database up to the current schema; returns the applied steps"""
+    applied = []
+    with bind.begin() as connection:
+        if "users" in inspect(connection).get_table_names() and add_user_change_seq(connection):
+            applied.append("users.change_seq")
+        if compact_calculations(connection):
+            applied.append("compact calculations layout")
+        if add_expression_columns(connection):
+            applied.append("calculations expression columns")
+        if add_created_at_index(connection):
+            applied.append("calculations (user_id, created_at) index")
+        if "users" in inspect(connection).get_table_names() and add_user_calculation_count(connection):
+            applied.append("users.calculation_count")
+        if add_job_lease_columns(connection):
+            applied.append("calculation_jobs lease columns")
+        if autoincrement_calculation_ids(connection):
+            applied.append("calculations AUTOINCREMENT ids")
+    # New tables (jobs, tombstones, ...) and anything else still missing
+    Base.metadata.create_all(bind=bind)
+    return applied
+
+
+if __name__ == "__main__":
+    steps = migrate()
+    print("Applied: " + ", ".join(steps) if steps else "Schema is up to date")
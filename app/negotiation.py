@@ -0,0 +1,172 @@
+"""
+Accept-based response formats for calculation listings and exports.
+
+Besides JSON, results can be returned as MessagePack or as an Arrow IPC
+stream (columnar; readable without parsing by pyarrow/pandas via
+`pyarrow.ipc.open_stream`). Both encoders are optional dependencies:
+
+    pip install msgpack pyarrow
+
+A format whose library is not installed is simply not offered.
+"""
+import io
+import json
+from datetime import datetime
+from typing import Iterable, Iterator, List, Tuple
+
+from fastapi import HTTPException, Request, status
+from fastapi.responses import Response
+
+try:
+    import msgpack
+except ImportError:  # optional dependency
+    msgpack = None
+
+try:
+    import pyarrow as pa
+except ImportError:  # optional dependency
+    pa = None
+
+JSON_TYPE = "application/json"
+NDJSON_TYPE = "application/x-ndjson"
+MSGPACK_TYPE = "application/msgpack"
+ARROW_TYPE = "application/vnd.apache.arrow.stream"
+
+MSGPACK_ALIASES = (MSGPACK_TYPE, "application/x-msgpack", "application/vnd.msgpack")
+WILDCARD_TYPES = ("application/*", "*/*")
+# Every negotiated response, including a 406, depends on Accept
+VARY_HEADERS = {"Vary": "Accept"}
+
+FIELDS = ("id", "operation", "operand1", "operand2", "result", "user_id", "created_at", "updated_at",
+          "expression", "variables")
+EXPORT_CHUNK_ROWS = 1000
+
+if pa is not None:
+    ARROW_SCHEMA = pa.schema([
+        ("id", pa.int64()),
+        ("operation", pa.dictionary(pa.int8(), pa.string())),
+        ("operand1", pa.float64()),
+        ("operand2", pa.float64()),
+        ("result", pa.float64()),
+        ("user_id", pa.int64()),
+        ("created_at", pa.timestamp("us")),
+        ("updated_at", pa.timestamp("us")),
+        ("expression", pa.string()),
+        ("variables", pa.string()),  # JSON object
+    ])
+
+
+def _parse_accept(header: str) -> List[Tuple[str, float]]:
+    accepted = []
+    for part in header.split(","):
+        media_type, _, params = part.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type:
+            accepted.append((media_type.strip().lower(), quality))
+    # Stable sort keeps the client's order among equal qualities
+    return sorted(accepted, key=lambda item: -item[1])
+
+
+def negotiate(request: Request, default: str = JSON_TYPE) -> str:
+    """Pick the response media type from the Accept header, or raise 406"""
+    header = request.headers.get("Accept")
+    if not header:
+        return default
+    for media_type, quality in _parse_accept(header):
+        if quality <= 0:
+            continue
+        if media_type == default or media_type in WILDCARD_TYPES:
+            return default
+        if media_type in MSGPACK_ALIASES and msgpack is not None:
+            return MSGPACK_TYPE
+        if media_type == ARROW_TYPE and pa is not None:
+            return ARROW_TYPE
+    offered = [default] + [MSGPACK_TYPE] * (msgpack is not None) + [ARROW_TYPE] * (pa is not None)
+    raise HTTPException(
+        status_code=status.HTTP_406_NOT_ACCEPTABLE,
+        detail="Supported formats: " + ", ".join(offered),
+        headers=VARY_HEADERS
+    )
+
+
+def _columns(rows: Iterable) -> dict:
+    columns = {name: [] for name in FIELDS}
+    for row in rows:
+        for name in FIELDS:
+            columns[name].append(row[name] if isinstance(row, dict) else getattr(row, name))
+    return columns
+
+
+def _plain_row(row) -> dict:
+    plain = {}
+    for name in FIELDS:
+        value = row[name] if isinstance(row, dict) else getattr(row, name)
+        plain[name] = value.isoformat() if isinstance(value, datetime) else value
+    return plain
+
+
+def _arrow_batch(rows: list):
+    columns = _columns(rows)
+    columns["variables"] = [None if value is None else json.dumps(value) for value in columns["variables"]]
+    return pa.RecordBatch.from_pydict(columns, schema=ARROW_SCHEMA)
+
+
+def encode_msgpack(rows: Iterable) -> bytes:
+    return msgpack.packb([_plain_row(row) for row in rows])
+
+
+def encode_arrow(rows: list) -> bytes:
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, ARROW_SCHEMA) as writer:
+        writer.write_batch(_arrow_batch(rows))
+    return sink.getvalue()
+
+
+def calculations_response(rows: list, media_type: str) -> Response:
+    """Encode a materialized list of calculations as MessagePack or Arrow"""
+    body = encode_arrow(rows) if media_type == ARROW_TYPE else encode_msgpack(rows)
+    return Response(content=body, media_type=media_type, headers=VARY_HEADERS)
+
+
+def _chunks(rows: Iterable, size: int) -> Iterator[list]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def stream_calculations(rows: Iterable, media_type: str, to_json) -> Iterator[bytes]:
+    """Encode calculations incrementally for streaming exports.
+
+    NDJSON and MessagePack are written as one record per row (MessagePack as a
+    stream of maps, readable with msgpack.Unpacker); Arrow as one record batch
+    per chunk. Rows are grouped into chunks so compression stays effective.
+    """
+    if media_type == ARROW_TYPE:
+        sink = io.BytesIO()
+        writer = pa.ipc.new_stream(sink, ARROW_SCHEMA)
+        for chunk in _chunks(rows, EXPORT_CHUNK_ROWS):
+            writer.write_batch(_arrow_batch(chunk))
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+        writer.close()
+        yield sink.getvalue()
+        return
+
+    for chunk in _chunks(rows, EXPORT_CHUNK_ROWS):
+        if media_type == MSGPACK_TYPE:
+            yield b"".join(msgpack.packb(_plain_row(row)) for row in chunk)
+        else:
+            yield "".join(to_json(row) + "\n" for row in chunk).encode("utf-8")
@@ -0,0 +1,169 @@
+"""
+Opt-in per-request profiling.
+
+A request is profiled when it carries `X-Profile: <PROFILE_TOKEN>` or is
+picked by `PROFILE_SAMPLE_RATE` (0.0 - 1.0). While it runs, a sampling
+thread records the Python stacks of the event loop and the worker threads
+every `PROFILE_INTERVAL_MS`, which covers sync endpoints and dependencies run
+in the threadpool as well as bcrypt, JWT, ORM and serialization work. Two
+files are written to `PROFILE_DIR` per profiled request:
+
+    <profile id>.collapsed   stacks in collapsed format (flamegraph.pl, speedscope)
+    <profile id>.txt         top functions by self and total samples
+
+The middleware is only installed when PROFILE_TOKEN or PROFILE_SAMPLE_RATE is
+set, so untriggered requests cost nothing when profiling is disabled.
+Samples are taken process-wide: concurrent requests show up in each other's
+profiles.
+"""
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "1"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(__file__), "..", "profiles"))
+PROFILE_TOP = 30
+
+# Frames where a thread is just waiting for work
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("selectors.py", "select"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+}
+
+
+def profiling_enabled() -> bool:
+    return bool(PROFILE_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self.started
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((os.path.basename(code.co_filename), code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                if not stack or (stack[0][0], stack[0][2]) in IDLE_FRAMES:
+                    continue
+                self.stacks[tuple(reversed(stack))] += 1
+                self.samples += 1
+
+    def collapsed(self) -> str:
+        lines = []
+        for stack, count in self.stacks.most_common():
+            frames = ";".join(f"{name} ({filename}:{line})" for filename, line, name in stack)
+            lines.append(f"{frames} {count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, title: str, top: int = PROFILE_TOP) -> str:
+        own_samples: Counter = Counter()
+        total_samples: Counter = Counter()
+        for stack, count in self.stacks.items():
+            own_samples[stack[-1]] += count
+            # Count recursive functions once per sample
+            for frame in set(stack):
+                total_samples[frame] += count
+
+        def table(counter: Counter) -> list:
+            rows = []
+            for (filename, line, name), count in counter.most_common(top):
+                share = 100.0 * count / self.samples if self.samples else 0.0
+                rows.append(f"{count:>8} {share:>6.1f}%  {name} ({filename}:{line})")
+            return rows
+
+        return "\n".join([
+            title,
+            f"{self.elapsed * 1000:.1f} ms, {self.samples} samples every {self.interval * 1000:g} ms",
+            "",
+            "Top functions by self samples:",
+            *table(own_samples),
+            "",
+            "Top functions by total samples:",
+            *table(total_samples),
+        ]) + "\n"
+
+    def write(self, directory: str, profile_id: str, title: str):
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, profile_id + ".collapsed"), "w", encoding="utf-8") as collapsed:
+            collapsed.write(self.collapsed())
+        with open(os.path.join(directory, profile_id + ".txt"), "w", encoding="utf-8") as summary:
+            summary.write(self.summary(title))
+
+
+class ProfilingMiddleware:
+    def __init__(self, app: ASGIApp, token: str = PROFILE_TOKEN, sample_rate: float = PROFILE_SAMPLE_RATE,
+                 directory: str = PROFILE_DIR, interval_ms: float = PROFILE_INTERVAL_MS):
+        self.app = app
+        self.token = token
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.interval = interval_ms / 1000.0
+
+    def _triggered(self, scope: Scope) -> bool:
+        if self.token:
+            header = Headers(scope=scope).get("X-Profile")
+            if header and hmac.compare_digest(header, self.token):
+                return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not self._triggered(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        status_code: Optional[int] = None
+
+        async def send_with_id(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                MutableHeaders(raw=message["headers"])["X-Profile-Id"] = profile_id
+            await send(message)
+
+        profiler = SamplingProfiler(self.interval)
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            profiler.stop()
+            title = f"{scope['method']} {scope['path']} -> {status_code}"
+            # Formatting and file I/O stay off the event loop
+            await run_in_threadpool(profiler.write, self.directory, profile_id, title)
@@ -0,0 +1,193 @@
+"""
+Bulk user provisioning from CSV or NDJSON.
+
+    python -m app.provision users.csv --workers 8 --batch-size 500
+
+Input rows need `username`, `email` and `password` (CSV header or NDJSON
+keys). Passwords are bcrypt-hashed across a process pool, duplicates are
+detected with one set-based query per chunk of input instead of two queries
+per user, and users are inserted in batches. Every rejected line is reported
+with its line number and reason.
+
+With sharding on (SHARD_URLS), uniqueness is checked against the user
+directory and every batch goes through the shard router, so provisioned
+users get global ids and land on their shard like registered ones.
+"""
+import argparse
+import csv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy import insert, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.auth import get_password_hash
+from app.database import SessionLocal, User
+from app.schemas import UserCreate
+from app.sharding import UserDirectoryEntry, get_shard_router
+
+LOOKUP_CHUNK_SIZE = 5000
+
+
+class ProvisionReport:
+    def __init__(self):
+        self.created = 0
+        self.conflicts: List[Tuple[int, str]] = []
+
+    def reject(self, line: int, reason: str):
+        self.conflicts.append((line, reason))
+
+
+class InvalidRecord:
+    """Stands in for an input line that could not be parsed"""
+
+    def __init__(self, reason: str):
+        self.reason = reason
+
+
+def _parse_line(line: str):
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError as exc:
+        return InvalidRecord(f"invalid JSON: {exc.msg} (column {exc.colno})")
+
+
+def read_users(path: str) -> List[Tuple[int, dict]]:
+    """Return (line number, record) pairs from a CSV or NDJSON file.
+
+    Unparseable NDJSON lines come back as InvalidRecord, so they are
+    reported with the other rejected lines instead of aborting the run.
+    """
+    with open(path, newline="", encoding="utf-8") as source:
+        if path.lower().endswith(".csv"):
+            reader = csv.DictReader(source)
+            # Line 1 is the header
+            return [(index + 2, dict(row)) for index, row in enumerate(reader)]
+        return [(index + 1, _parse_line(line)) for index, line in enumerate(source) if line.strip()]
+
+
+def _existing(db: Session, usernames: List[str], emails: List[str], model=User) -> Tuple[set, set]:
+    taken_usernames, taken_emails = set(), set()
+    for start in range(0, max(len(usernames), len(emails)), LOOKUP_CHUNK_SIZE):
+        chunk_usernames = usernames[start:start + LOOKUP_CHUNK_SIZE]
+        chunk_emails = emails[start:start + LOOKUP_CHUNK_SIZE]
+        rows = db.execute(select(model.username, model.email).where(or_(
+            model.username.in_(chunk_usernames),
+            model.email.in_(chunk_emails)
+        )))
+        for username, email in rows:
+            taken_usernames.add(username)
+            taken_emails.add(email)
+    return taken_usernames, taken_emails
+
+
+def _insert_batch(db: Session, batch: List[Tuple[int, dict]], report: ProvisionReport):
+    router = get_shard_router()
+
+    def insert_rows(rows: List[dict]):
+        if router is not None:
+            router.register_users(rows)
+            return
+        db.execute(insert(User), rows)
+        db.commit()
+
+    try:
+        insert_rows([values for _, values in batch])
+        report.created += len(batch)
+        return
+    except IntegrityError:
+        db.rollback()
+    # Someone registered a conflicting user meanwhile: fall back to row by row
+    for line, values in batch:
+        try:
+            insert_rows([values])
+            report.created += 1
+        except IntegrityError:
+            db.rollback()
+            report.reject(line, "username or email already registered")
+
+
+def provision_users(db: Session, records: Iterable[Tuple[int, dict]], workers: Optional[int] = None,
+                    batch_size: int = 500) -> ProvisionReport:
+    report = ProvisionReport()
+
+    # Validate and drop duplicates within the file (first occurrence wins)
+    valid: List[Tuple[int, UserCreate]] = []
+    seen_usernames: Dict[str, int] = {}
+    seen_emails: Dict[str, int] = {}
+    for line, record in records:
+        if isinstance(record, InvalidRecord):
+            report.reject(line, record.reason)
+            continue
+        try:
+            user = UserCreate.model_validate(record)
+        except ValidationError as exc:
+            report.reject(line, "; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in exc.errors()))
+            continue
+        if user.username in seen_usernames:
+            report.reject(line, f"duplicate username in input (line {seen_usernames[user.username]})")
+            continue
+        if user.email in seen_emails:
+            report.reject(line, f"duplicate email in input (line {seen_emails[user.email]})")
+            continue
+        seen_usernames[user.username] = line
+        seen_emails[user.email] = line
+        valid.append((line, user))
+
+    usernames, emails = [user.username for _, user in valid], [user.email for _, user in valid]
+    router = get_shard_router()
+    if router is not None:
+        with Session(router.directory_engine) as directory:
+            taken_usernames, taken_emails = _existing(directory, usernames, emails, UserDirectoryEntry)
+    else:
+        taken_usernames, taken_emails = _existing(db, usernames, emails)
+    accepted = []
+    for line, user in valid:
+        if user.username in taken_usernames:
+            report.reject(line, "username already registered")
+        elif user.email in taken_emails:
+            report.reject(line, "email already registered")
+        else:
+            accepted.append((line, user))
+
+    hashes = []
+    if accepted:
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunksize = max(1, len(accepted) // (workers * 4))
+            hashes = list(pool.map(get_password_hash, [user.password for _, user in accepted], chunksize=chunksize))
+
+    rows = [
+        (line, {"username": user.username, "email": user.email, "hashed_password": hashed})
+        for (line, user), hashed in zip(accepted, hashes)
+    ]
+    for start in range(0, len(rows), batch_size):
+        _insert_batch(db, rows[start:start + batch_size], report)
+
+    report.conflicts.sort()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Provision users in bulk from CSV or NDJSON")
+    parser.add_argument("path", help="CSV with a username,email,password header, or NDJSON")
+    parser.add_argument("--workers", type=int, default=None, help="hashing processes (default: all cores)")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        report = provision_users(db, read_users(args.path), args.workers, args.batch_size)
+    finally:
+        db.close()
+    for line, reason in report.conflicts:
+        print(f"line {line}: {reason}")
+    print(f"Created {report.created} users, rejected {len(report.conflicts)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""
+Request deadlines and a database circuit breaker.
+
+Every HTTP request gets a time budget (REQUEST_DEADLINE_MS, or a smaller
+`X-Request-Timeout` header in milliseconds). The budget follows the request
+into the threadpool and is enforced on the database side:
+
+- a statement is not sent at all once the budget is spent
+- Postgres transactions run with `SET LOCAL statement_timeout` set to the
+  remaining budget
+- SQLite statements are interrupted by a progress handler
+
+The budget ends when the response starts, so streamed bodies (exports) are
+not cut off.
+
+Each engine also has a circuit breaker. After BREAKER_FAILURE_THRESHOLD
+consecutive operational errors (connection failures, statement timeouts)
+it opens and statements fail immediately with 503 instead of queueing on a
+sick database. After BREAKER_RESET_SECONDS one probe is let through
+(half-open); its outcome closes or re-opens the breaker.
+"""
+import math
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, Iterable, Optional, Tuple
+
+from fastapi import Request, status
+from fastapi.responses import JSONResponse
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import InterfaceError, OperationalError, SQLAlchemyError
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from dotenv import load_dotenv
+
+load_dotenv()
+
+REQUEST_DEADLINE_MS = int(os.getenv("REQUEST_DEADLINE_MS", "30000"))  # 0 disables deadlines
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "10"))
+SQLITE_PROGRESS_STEPS = 1000  # VM instructions between deadline checks
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class CircuitOpen(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__("Database unavailable")
+        self.retry_after = retry_after
+
+
+class Deadline:
+    def __init__(self, seconds: float, requested: bool = False):
+        self.expires: Optional[float] = time.monotonic() + seconds
+        # Set when the client shortened the budget; its timeouts say nothing about database health
+        self.requested = requested
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left, or None when no deadline applies"""
+        if self.expires is None:
+            return None
+        return self.expires - time.monotonic()
+
+
+_deadline: ContextVar[Optional[Deadline]] = ContextVar("request_deadline", default=None)
+
+
+def remaining_time() -> Optional[float]:
+    deadline = _deadline.get()
+    return deadline.remaining() if deadline is not None else None
+
+
+class request_deadline:
+    """Apply a deadline to a block of code outside the middleware"""
+
+    def __init__(self, seconds: float):
+        self.deadline = Deadline(seconds)
+
+    def __enter__(self):
+        self._token = _deadline.set(self.deadline)
+        return self.deadline
+
+    def __exit__(self, *exc_info):
+        _deadline.reset(self._token)
+
+
+class DeadlineMiddleware:
+    def __init__(self, app: ASGIApp, default_ms: int = REQUEST_DEADLINE_MS):
+        self.app = app
+        self.default_ms = default_ms
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or self.default_ms <= 0:
+            await self.app(scope, receive, send)
+            return
+        budget_ms = self.default_ms
+        requested = Headers(scope=scope).get("X-Request-Timeout")
+        if requested:
+            try:
+                budget_ms = min(budget_ms, max(1, int(requested)))
+            except ValueError:
+                pass
+        deadline = Deadline(budget_ms / 1000, requested=budget_ms < self.default_ms)
+
+        async def send_and_release(message: Message):
+            if message["type"] == "http.response.start":
+                # The budget covers producing the response, not streaming it
+                deadline.expires = None
+            await send(message)
+
+        token = _deadline.set(deadline)
+        try:
+            await self.app(scope, receive, send_and_release)
+        finally:
+            _deadline.reset(token)
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_started: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Whether a database call may proceed; in half-open state only one probe does"""
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            if self.state == OPEN:
+                if now - self.opened_at < self.reset_seconds:
+                    return False
+                self.state = HALF_OPEN
+                self._probe_started = None
+            if self.state == HALF_OPEN:
+                # A probe that never reported back does not block recovery forever
+                if self._probe_started is None or now - self._probe_started >= self.reset_seconds:
+                    self._probe_started = now
+                    return True
+                return False
+            return True
+
+    def available(self) -> bool:
+        """Like allow(), but without claiming the half-open probe"""
+        return not (self.state == OPEN and time.monotonic() - self.opened_at < self.reset_seconds)
+
+    def check(self):
+        if not self.allow():
+            raise CircuitOpen(self.retry_after())
+
+    def retry_after(self) -> float:
+        return max(0.0, self.reset_seconds - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        if self.state == CLOSED and not self.failures:
+            return
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self._probe_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self._probe_started = None
+
+
+_breakers: Dict[Engine, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(bind: Engine) -> CircuitBreaker:
+    breaker = _breakers.get(bind)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(bind, CircuitBreaker())
+    return breaker
+
+
+def pool_status(bind: Engine) -> dict:
+    pool = bind.pool
+    status = {"class": type(pool).__name__}
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        method = getattr(pool, name, None)
+        if callable(method):
+            status[name] = method()
+    return status
+
+
+@event.listens_for(Engine, "begin")
+def _set_statement_timeout(conn):
+    remaining = remaining_time()
+    if remaining is None or conn.dialect.name != "postgresql":
+        return
+    # SET LOCAL ends with the transaction, so pooled connections stay clean
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        cursor.execute(f"SET LOCAL statement_timeout = {max(1, int(remaining * 1000))}")
+    finally:
+        cursor.close()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _check_before_execute(conn, cursor, statement, parameters, context, executemany):
+    get_breaker(conn.engine).check()
+    remaining = remaining_time()
+    if remaining is None:
+        return
+    if remaining <= 0:
+        raise DeadlineExceeded("Request deadline exceeded")
+    if conn.dialect.name == "sqlite":
+        expires = time.monotonic() + remaining
+        cursor.connection.set_progress_handler(lambda: time.monotonic() > expires, SQLITE_PROGRESS_STEPS)
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _record_success(conn, cursor, statement, parameters, context, executemany):
+    if conn.dialect.name == "sqlite" and _deadline.get() is not None:
+        cursor.connection.set_progress_handler(None, SQLITE_PROGRESS_STEPS)
+    get_breaker(conn.engine).record_success()
+
+
+@event.listens_for(Engine, "handle_error")
+def _record_failure(exception_context):
+    context = exception_context.execution_context
+    if context is not None and context.dialect.name == "sqlite" and context.cursor is not None:
+        context.cursor.connection.set_progress_handler(None, SQLITE_PROGRESS_STEPS)
+    error = exception_context.sqlalchemy_exception
+    if exception_context.engine is None or not (
+        exception_context.is_disconnect or isinstance(error, (OperationalError, InterfaceError))
+    ):
+        return
+    deadline = _deadline.get()
+    if deadline is not None and deadline.requested and (deadline.remaining() or 0) <= 0:
+        return
+    get_breaker(exception_context.engine).record_failure()
+
+
+def database_unavailable(request: Request, exc: Exception) -> JSONResponse:
+    """Exception handler: database trouble is a 503, not a 500"""
+    headers = {}
+    if isinstance(exc, CircuitOpen):
+        headers["Retry-After"] = str(max(1, math.ceil(exc.retry_after)))
+        detail = "Database unavailable"
+    elif isinstance(exc, DeadlineExceeded) or "interrupted" in str(exc) or "statement timeout" in str(exc):
+        detail = "Request deadline exceeded"
+    else:
+        detail = "Database unavailable"
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"detail": detail},
+                        headers=headers)
+
+
+def readiness(binds: Iterable[Engine]) -> Tuple[bool, dict]:
+    """Breaker and pool state of every engine, each probed with `SELECT 1`"""
+    ready = True
+    databases = []
+    for bind in binds:
+        breaker = get_breaker(bind)
+        entry = {"url": bind.url.render_as_string(hide_password=True), "breaker": breaker.state,
+                 "consecutive_failures": breaker.failures, "pool": pool_status(bind)}
+        if breaker.available():
+            try:
+                with bind.connect() as conn:
+                    conn.execute(text("SELECT 1"))
+                entry["probe"] = "ok"
+            except (SQLAlchemyError, DeadlineExceeded, CircuitOpen) as exc:
+                entry["probe"] = type(exc).__name__
+        else:
+            entry["probe"] = "skipped"
+        # The probe may have changed the breaker (e.g. closed it from half-open)
+        entry["breaker"] = breaker.state
+        ready = ready and entry["probe"] == "ok"
+        databases.append(entry)
+    return ready, {"status": "ready" if ready else "unavailable", "databases": databases}
@@ -0,0 +1,250 @@
+"""
+Retention purge for old calculations.
+
+Policies live in `retention_policies`: a row with a `user_id` applies to
+that user, the row without one is the global policy for everyone else, and
+users covered by neither keep their calculations forever.
+
+The purge never issues one large DELETE. For each user it deletes at most
+RETENTION_BATCH_SIZE expired rows per transaction, found through the
+`(user_id, created_at)` index, and pauses RETENTION_PAUSE_MS between
+batches so other writers get the table (and the WAL/redo log can be
+recycled). Every batch also writes delta sync tombstones, queues `deleted`
+events and advances the run's checkpoint in `retention_runs`, so an
+interrupted run resumes with the next unfinished user. Archived copies past
+the window are purged from cold storage as well.
+
+    python -m app.retention run
+    python -m app.retention policy --days 730               # global policy
+    python -m app.retention policy --days 90 --user alice
+    python -m app.retention policy --clear --user alice
+
+Set RETENTION_INTERVAL_SECONDS to also run the purge periodically inside the
+API process. With sharding on, policies and runs are kept per shard: the
+API runs one worker per shard, `run` purges every shard, a global policy is
+written to every shard and a user's policy to the shard holding the user.
+"""
+import argparse
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from sqlalchemy import delete, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker
+from dotenv import load_dotenv
+
+from app.archive import find_expired_archived, purge_archived_calculations
+from app.changes import record_deletions
+from app.database import SessionLocal, Calculation, RetentionPolicy, RetentionRun, User
+from app.events import queue_calculation_event
+from app.sharding import data_engines
+
+load_dotenv()
+
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "1000"))
+RETENTION_PAUSE_MS = int(os.getenv("RETENTION_PAUSE_MS", "50"))
+RETENTION_INTERVAL_SECONDS = int(os.getenv("RETENTION_INTERVAL_SECONDS", "0"))  # 0 = only via CLI
+USER_PAGE_SIZE = 500
+
+
+def set_policy(db: Session, retain_days: Optional[int], user_id: Optional[int] = None):
+    """Create, change or (with retain_days=None) remove a policy"""
+    policy = db.query(RetentionPolicy).filter(RetentionPolicy.user_id.is_(None) if user_id is None
+                                              else RetentionPolicy.user_id == user_id).first()
+    if retain_days is None:
+        if policy is not None:
+            db.delete(policy)
+    elif policy is None:
+        db.add(RetentionPolicy(user_id=user_id, retain_days=retain_days))
+    else:
+        policy.retain_days = retain_days
+    db.commit()
+
+
+def _policies(db: Session):
+    global_days = None
+    per_user: Dict[int, int] = {}
+    for user_id, retain_days in db.query(RetentionPolicy.user_id, RetentionPolicy.retain_days):
+        if user_id is None:
+            global_days = retain_days
+        else:
+            per_user[user_id] = retain_days
+    return global_days, per_user
+
+
+def _purge_user(db: Session, run: RetentionRun, user_id: int, cutoff: datetime,
+                batch_size: int, pause: float) -> int:
+    deleted = 0
+    while True:
+        ids = db.execute(
+            select(Calculation.id)
+            .where(Calculation.user_id == user_id, Calculation.created_at < cutoff)
+            .limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            break
+        # Only rows this statement removed; others may have been deleted concurrently
+        removed = db.execute(
+            delete(Calculation).where(Calculation.id.in_(ids)).returning(Calculation.id)
+            .execution_options(synchronize_session=False)
+        ).scalars().all()
+        record_deletions(db, user_id, removed)
+        for calculation_id in removed:
+            queue_calculation_event(db, user_id, {"type": "deleted", "data": {"id": calculation_id}})
+        run.deleted += len(removed)
+        db.commit()
+        deleted += len(removed)
+        if len(ids) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+
+    archived_ids = find_expired_archived(user_id, cutoff)
+    if archived_ids:
+        # Tombstones first: a crash before the rewrite only repeats the purge
+        record_deletions(db, user_id, archived_ids, counted=False)
+        run.deleted += len(archived_ids)
+        db.commit()
+        purge_archived_calculations(user_id, cutoff)
+        deleted += len(archived_ids)
+    return deleted
+
+
+def purge_expired(db: Session, batch_size: Optional[int] = None, pause_ms: Optional[int] = None,
+                  now: Optional[datetime] = None) -> int:
+    """Delete calculations past their retention window; returns the number deleted.
+
+    Resumes the last unfinished run from its checkpoint if there is one.
+    """
+    batch_size = batch_size or RETENTION_BATCH_SIZE
+    pause = (RETENTION_PAUSE_MS if pause_ms is None else pause_ms) / 1000.0
+    now = now or datetime.utcnow()
+
+    global_days, per_user = _policies(db)
+    if global_days is None and not per_user:
+        return 0
+
+    run = db.query(RetentionRun).filter(RetentionRun.status == "running").order_by(RetentionRun.id).first()
+    if run is None:
+        run = RetentionRun(status="running", cursor_user_id=0, deleted=0)
+        db.add(run)
+        db.commit()
+    deleted = 0
+
+    while True:
+        users = select(User.id).where(User.id > run.cursor_user_id).order_by(User.id).limit(USER_PAGE_SIZE)
+        if global_days is None:
+            users = users.where(User.id.in_(list(per_user)))
+        user_ids = db.execute(users).scalars().all()
+        if not user_ids:
+            break
+        for user_id in user_ids:
+            cutoff = now - timedelta(days=per_user.get(user_id, global_days))
+            deleted += _purge_user(db, run, user_id, cutoff, batch_size, pause)
+            run.cursor_user_id = user_id
+            db.commit()
+
+    run.status = "completed"
+    run.finished_at = datetime.utcnow()
+    db.commit()
+    return deleted
+
+
+class RetentionWorker:
+    """Runs the purge every `interval` seconds in a daemon thread"""
+
+    def __init__(self, bind: Engine, interval: int = RETENTION_INTERVAL_SECONDS):
+        self.session_factory = sessionmaker(autocommit=False, autoflush=False, bind=bind)
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="retention-purge", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            db = self.session_factory()
+            try:
+                purge_expired(db)
+            except Exception:
+                # The checkpoint lets the next round pick up where this one failed
+                db.rollback()
+            finally:
+                db.close()
+
+    def stop(self, wait: bool = True):
+        self._stop.set()
+        if wait:
+            self._thread.join()
+
+
+_workers: Dict[Engine, RetentionWorker] = {}
+_workers_lock = threading.Lock()
+
+
+def start_retention_worker(bind: Engine):
+    """Start the periodic purge for an engine once, if RETENTION_INTERVAL_SECONDS is set"""
+    if RETENTION_INTERVAL_SECONDS <= 0:
+        return
+    with _workers_lock:
+        if bind not in _workers:
+            _workers[bind] = RetentionWorker(bind)
+
+
+def stop_retention_worker(wait: bool = True):
+    with _workers_lock:
+        workers = list(_workers.values())
+        _workers.clear()
+    for worker in workers:
+        worker.stop(wait)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Purge calculations past their retention window")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="delete expired calculations in batches")
+    run.add_argument("--batch-size", type=int, default=RETENTION_BATCH_SIZE)
+    run.add_argument("--pause-ms", type=int, default=RETENTION_PAUSE_MS,
+                     help="sleep between batches to leave room for other writers")
+    policy = commands.add_parser("policy", help="set or clear a retention policy")
+    policy.add_argument("--user", help="username; omit for the global policy")
+    group = policy.add_mutually_exclusive_group(required=True)
+    group.add_argument("--days", type=int, help="keep calculations for this many days")
+    group.add_argument("--clear", action="store_true", help="remove the policy")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        count = 0
+        for bind in data_engines():
+            db = SessionLocal(bind=bind)
+            try:
+                count += purge_expired(db, args.batch_size, args.pause_ms)
+            finally:
+                db.close()
+        print(f"Deleted {count} expired calculations")
+        return
+
+    found = False
+    for bind in data_engines():
+        db = SessionLocal(bind=bind)
+        try:
+            user_id = None
+            if args.user:
+                user = db.query(User).filter(User.username == args.user).first()
+                if user is None:
+                    continue  # on another shard
+                user_id = user.id
+            set_policy(db, None if args.clear else args.days, user_id)
+            found = True
+        finally:
+            db.close()
+    if not found:
+        parser.error(f"unknown user {args.user}")
+    scope = f"user {args.user}" if args.user else "global"
+    print(f"Cleared {scope} policy" if args.clear else f"Set {scope} retention to {args.days} days")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,20 +4,28 @@ from sqlalchemy.orm import Session
 from datetime import timedelta
 
 from app.database import get_db, User
-from app.schemas import UserCreate, UserResponse, Token
+from app.schemas import UserCreate, UserResponse, Token, RefreshRequest
 from app.auth import (
     get_password_hash,
     authenticate_user,
     create_access_token,
+    create_refresh_token,
+    rotate_refresh_token,
+    revoke_refresh_token,
     ACCESS_TOKEN_EXPIRE_MINUTES,
     get_current_user
 )
+from app.sharding import DirectoryConflict, get_shard_router
 
 router = APIRouter(prefix="/auth", tags=["Authentication"])
 
 
 @router.post("/register", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
 def register(user: UserCreate, db: Session = Depends(get_db)):
+    shard_router = get_shard_router()
+    if shard_router is not None:
+        return register_sharded(shard_router, user, db)
+
     # Check if username exists
     db_user = db.query(User).filter(User.username == user.username).first()
     if db_user:
@@ -47,9 +55,27 @@ def register(user: UserCreate, db: Session = Depends(get_db)):
     return db_user
 
 
+def register_sharded(shard_router, user: UserCreate, db: Session):
+    # The directory enforces uniqueness across shards
+    taken = shard_router.taken_field(user.username, user.email)
+    if taken is None:
+        try:
+            return shard_router.register_user(db, user.username, user.email, get_password_hash(user.password))
+        except DirectoryConflict as exc:
+            taken = exc.field
+    raise HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail=f"{taken.capitalize()} already registered"
+    )
+
+
 @router.post("/token", response_model=Token)
 def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = authenticate_user(db, form_data.username, form_data.password)
+    shard_router = get_shard_router()
+    if shard_router is not None and not shard_router.bind_user(db, form_data.username):
+        user = False
+    else:
+        user = authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -61,7 +87,32 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depend
     access_token = create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
     )
-    return {"access_token": access_token, "token_type": "bearer"}
+    refresh_token = create_refresh_token(db, user.id)
+    db.commit()
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
+
+
+@router.post("/refresh", response_model=Token)
+def refresh(request: RefreshRequest, db: Session = Depends(get_db)):
+    """Exchange a refresh token for a new access token and a rotated refresh token"""
+    shard_router = get_shard_router()
+    if shard_router is not None:
+        shard_router.bind_refresh_token(db, request.refresh_token)
+    user, refresh_token = rotate_refresh_token(db, request.refresh_token)
+    access_token = create_access_token(
+        data={"sub": user.username}, expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    )
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
+
+
+@router.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+def logout(request: RefreshRequest, db: Session = Depends(get_db)):
+    """Revoke a refresh token (and its rotation chain)"""
+    shard_router = get_shard_router()
+    if shard_router is not None:
+        shard_router.bind_refresh_token(db, request.refresh_token)
+    revoke_refresh_token(db, request.refresh_token)
+    return None
 
 
 @router.get("/me", response_model=UserResponse)
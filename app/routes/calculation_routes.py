@@ -1,16 +1,66 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+import asyncio
+import json
+import os
+from datetime import datetime
+
+from fastapi import (APIRouter, Depends, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect,
+                     status)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy import and_, case, func, select
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional, Tuple
 
 from app.database import get_db, User, Calculation
-from app.schemas import CalculationCreate, CalculationUpdate, CalculationResponse
-from app.auth import get_current_user
+from app.schemas import (CalculationCreate, CalculationUpdate, CalculationResponse, CalculationChanges,
+                         CalculationFilter, BulkUpdateResult, BulkDeleteResult,
+                         ExpressionEvaluate, ExpressionResults, OPERATION_PATTERN)
+from app.auth import get_current_user, get_user_from_token
+from app import group_commit
+from app.archive import find_archived_calculation, iter_archived_calculations
+from app.bulk import delete_by_filter, filter_conditions, filter_criteria, update_by_filter
+from app.events import get_event_broker
+from app.changes import get_changes_since
+from app.tracing import traced
+from app.expressions import ExpressionError, compile_expression
+from app.negotiation import (JSON_TYPE, NDJSON_TYPE, VARY_HEADERS, negotiate, calculations_response,
+                             stream_calculations)
 
 router = APIRouter(prefix="/calculations", tags=["Calculations"])
 
+# WebSocket flow control: messages buffered per connection and rows per insert batch
+WS_MAX_IN_FLIGHT = int(os.getenv("WS_MAX_IN_FLIGHT", "1000"))
+WS_MAX_BATCH = int(os.getenv("WS_MAX_BATCH", "200"))
+INVALID_JSON = object()
+_CLOSED = object()  # end of a WebSocket's message queue; `null` is a message like any other
+
+# Server-Sent Events: seconds between keep-alive comments on an idle stream
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+
+# Approximate totals: most recent rows inspected to estimate a filtered count
+TOTAL_COUNT_SAMPLE_SIZE = int(os.getenv("TOTAL_COUNT_SAMPLE_SIZE", "1000"))
 
-def calculate_result(operation: str, operand1: float, operand2: float) -> float:
+
+@traced("calculate_result")
+def calculate_result(operation: str, operand1: Optional[float], operand2: Optional[float],
+                     expression: Optional[str] = None, variables: Optional[dict] = None) -> float:
     """Perform calculation based on operation type"""
+    if operation == "expression":
+        if expression is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="expression is required for the expression operation"
+            )
+        try:
+            return compile_expression(expression).evaluate(variables)
+        except ExpressionError as exc:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc))
+    if operation in ("add", "subtract", "multiply", "divide") and (operand1 is None or operand2 is None):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"operand1 and operand2 are required for {operation}"
+        )
     if operation == "add":
         return operand1 + operand2
     elif operation == "subtract":
@@ -27,10 +77,30 @@ def calculate_result(operation: str, operand1: float, operand2: float) -> float:
     else:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid operation. Must be one of: add, subtract, multiply, divide"
+            detail="Invalid operation. Must be one of: add, subtract, multiply, divide, expression"
         )
 
 
+def calculation_values(calculation: CalculationCreate) -> dict:
+    """Column values (including the result) for a validated calculation"""
+    values = {
+        "operation": calculation.operation,
+        "operand1": calculation.operand1,
+        "operand2": calculation.operand2,
+        "result": calculate_result(
+            calculation.operation,
+            calculation.operand1,
+            calculation.operand2,
+            calculation.expression,
+            calculation.variables
+        )
+    }
+    if calculation.operation == "expression":
+        values["expression"] = calculation.expression
+        values["variables"] = calculation.variables
+    return values
+
+
 # Add (Create) - POST /calculations
 @router.post("/", response_model=CalculationResponse, status_code=status.HTTP_201_CREATED)
 def create_calculation(
@@ -40,20 +110,16 @@ def create_calculation(
 ):
     """Create a new calculation"""
     # Calculate result
-    result = calculate_result(
-        calculation.operation,
-        calculation.operand1,
-        calculation.operand2
-    )
+    values = calculation_values(calculation)
+    values["user_id"] = current_user.id
+    
+    if group_commit.GROUP_COMMIT_ENABLED:
+        # Share a commit with concurrent requests; returns after the batch commits
+        writer = group_commit.get_group_commit_writer(db.get_bind())
+        return writer.insert(values)
     
     # Create calculation object
-    db_calculation = Calculation(
-        operation=calculation.operation,
-        operand1=calculation.operand1,
-        operand2=calculation.operand2,
-        result=result,
-        user_id=current_user.id
-    )
+    db_calculation = Calculation(**values)
     
     db.add(db_calculation)
     db.commit()
@@ -61,21 +127,246 @@ def create_calculation(
     return db_calculation
 
 
+# Evaluate one expression for many variable bindings without storing anything
+@router.post("/evaluate", response_model=ExpressionResults)
+def evaluate_expression(
+    evaluation: ExpressionEvaluate,
+    current_user: User = Depends(get_current_user)
+):
+    """Evaluate an expression for every set of variables in one call"""
+    compiled = compile_expression(evaluation.expression)
+    results, errors = [], []
+    for index, (result, error) in enumerate(compiled.evaluate_many(evaluation.bindings)):
+        results.append(result)
+        if error is not None:
+            errors.append({"index": index, "error": error})
+    return {"results": results, "errors": errors}
+
+
+def total_count(db: Session, user: User, filters: CalculationFilter, approximate: bool) -> Tuple[int, bool]:
+    """Total for the pagination headers; returns (count, whether it is an estimate).
+
+    Unfiltered totals come from the maintained users.calculation_count.
+    Filtered ones are counted, or with `approximate` extrapolated from the
+    share of matches among the user's most recent calculations.
+    """
+    conditions = filter_criteria(filters)
+    if not conditions:
+        return user.calculation_count, False
+    if not approximate:
+        return db.query(func.count(Calculation.id)).filter(
+            Calculation.user_id == user.id, *conditions
+        ).scalar(), False
+    sample = select(case((and_(*conditions), 1), else_=0).label("matches")).where(
+        Calculation.user_id == user.id
+    ).order_by(Calculation.id.desc()).limit(TOTAL_COUNT_SAMPLE_SIZE).subquery()
+    sampled, matched = db.execute(select(func.count(), func.coalesce(func.sum(sample.c.matches), 0))).one()
+    if sampled < TOTAL_COUNT_SAMPLE_SIZE:
+        return matched, False  # the sample was every row the user has
+    return round(user.calculation_count * matched / sampled), True
+
+
 # Browse (List All) - GET /calculations
 @router.get("/", response_model=List[CalculationResponse])
 def get_calculations(
+    request: Request,
+    response: Response,
     skip: int = 0,
     limit: int = 100,
+    operation: Optional[str] = Query(None, pattern=OPERATION_PATTERN),
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    count: str = Query("exact", pattern="^(exact|approximate)$"),
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
-    """Retrieve all calculations for the logged-in user"""
+    """Retrieve all calculations for the logged-in user, optionally filtered.
+
+    Returns JSON by default, or MessagePack / Arrow IPC when requested via Accept.
+    The total number of matching calculations is sent in X-Total-Count.
+    """
+    media_type = negotiate(request)
+    filters = CalculationFilter(operation=operation, created_from=created_from, created_to=created_to)
     calculations = db.query(Calculation).filter(
-        Calculation.user_id == current_user.id
+        *filter_conditions(current_user.id, filters)
     ).offset(skip).limit(limit).all()
+    total, estimated = total_count(db, current_user, filters, count == "approximate")
+    headers = {"X-Total-Count": str(total), **VARY_HEADERS}
+    if estimated:
+        headers["X-Total-Count-Approximate"] = "true"
+    if media_type != JSON_TYPE:
+        negotiated = calculations_response(calculations, media_type)
+        negotiated.headers.update(headers)
+        return negotiated
+    response.headers.update(headers)
     return calculations
 
 
+def calculation_filter(
+    ids: Optional[List[int]] = Query(None),
+    operation: Optional[str] = Query(None, pattern=OPERATION_PATTERN),
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None
+) -> CalculationFilter:
+    """Filter for the bulk routes, from query parameters (`ids` may repeat)"""
+    filters = CalculationFilter(ids=ids, operation=operation, created_from=created_from, created_to=created_to)
+    if not (filters.ids or filters.operation or filters.created_from or filters.created_to):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="At least one filter is required: ids, operation, created_from or created_to"
+        )
+    return filters
+
+
+# Bulk Edit - PATCH /calculations?<filter>
+@router.patch("/", response_model=BulkUpdateResult)
+def update_calculations(
+    calculation_update: CalculationUpdate,
+    filters: CalculationFilter = Depends(calculation_filter),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Update every matching calculation with one set-based statement.
+
+    Results are recomputed in the database. Rows that would divide by zero
+    are reported and left unchanged; expression calculations are skipped.
+    """
+    changes = calculation_update.model_dump(exclude_none=True)
+    if changes.get("operation") == "expression" or "expression" in changes or "variables" in changes:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Expressions cannot be updated in bulk"
+        )
+    if not changes:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="No changes given"
+        )
+    return update_by_filter(db, current_user.id, filters, changes)
+
+
+# Bulk Delete - DELETE /calculations?<filter>
+@router.delete("/", response_model=BulkDeleteResult)
+def delete_calculations(
+    filters: CalculationFilter = Depends(calculation_filter),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Delete every matching calculation with one set-based statement"""
+    return {"deleted": delete_by_filter(db, current_user.id, filters)}
+
+
+# Export - GET /calculations/export
+@router.get("/export")
+def export_calculations(
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Stream all calculations of the logged-in user, including archived ones.
+
+    NDJSON by default; MessagePack or Arrow IPC stream when requested via Accept.
+    """
+    media_type = negotiate(request, default=NDJSON_TYPE)
+    user_id = current_user.id
+    hot_query = db.query(Calculation).filter(
+        Calculation.user_id == user_id
+    ).order_by(Calculation.id).yield_per(1000)
+
+    def rows():
+        seen = set()
+        for calculation in hot_query:
+            seen.add(calculation.id)
+            yield calculation
+        for archived in iter_archived_calculations(user_id):
+            if archived["id"] in seen:
+                continue
+            seen.add(archived["id"])
+            yield archived
+
+    def to_json(row):
+        return CalculationResponse.model_validate(row).model_dump_json()
+
+    return StreamingResponse(
+        stream_calculations(rows(), media_type, to_json),
+        media_type=media_type,
+        headers=VARY_HEADERS
+    )
+
+
+# Delta sync - GET /calculations/changes?since=<token>
+@router.get("/changes", response_model=CalculationChanges)
+def get_calculation_changes(
+    since: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=10000),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Return calculations created or updated, and ids deleted, after a checkpoint.
+
+    Omit `since` for a full sync. Pass the returned `next_token` on the next
+    call; keep calling while `has_more` is true.
+    """
+    try:
+        checkpoint = int(since) if since else 0
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid sync token"
+        )
+    changes, deleted, checkpoint, has_more = get_changes_since(db, current_user.id, checkpoint, limit)
+    return {
+        "changes": changes,
+        "deleted": deleted,
+        "next_token": str(checkpoint),
+        "has_more": has_more
+    }
+
+
+# Change feed - GET /calculations/events
+@router.get("/events")
+async def calculation_events(
+    request: Request,
+    token: Optional[str] = Query(None),
+    db: Session = Depends(get_db)
+):
+    """Server-Sent Events stream of created/updated/deleted calculations.
+
+    EventSource cannot send headers, so the access token may be passed as
+    the `token` query parameter instead of an Authorization header.
+    """
+    if token is None:
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "bearer":
+            token = ""
+    user = await run_in_threadpool(get_user_from_token, token, db)
+    user_id = user.id
+    # The stream is long-lived; do not hold a pooled connection while idle
+    db.close()
+
+    broker = get_event_broker()
+    subscription = broker.subscribe(user_id)
+
+    async def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(subscription.get(), SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+        finally:
+            broker.unsubscribe(subscription)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 # Read (Get One) - GET /calculations/{id}
 @router.get("/{calculation_id}", response_model=CalculationResponse)
 def get_calculation(
@@ -89,6 +380,10 @@ def get_calculation(
         Calculation.user_id == current_user.id
     ).first()
     
+    if not calculation:
+        # Fall back to cold storage for calculations moved out by the archiver
+        calculation = find_archived_calculation(current_user.id, calculation_id)
+    
     if not calculation:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -125,12 +420,19 @@ def update_calculation(
     if update_data:
         for field, value in update_data.items():
             setattr(db_calculation, field, value)
+        # Switching kind drops the inputs of the other kind
+        if db_calculation.operation == "expression":
+            db_calculation.operand1 = db_calculation.operand2 = None
+        else:
+            db_calculation.expression = db_calculation.variables = None
         
         # Recalculate result
         db_calculation.result = calculate_result(
             db_calculation.operation,
             db_calculation.operand1,
-            db_calculation.operand2
+            db_calculation.operand2,
+            db_calculation.expression,
+            db_calculation.variables
         )
         
         db.commit()
@@ -173,3 +475,111 @@ def delete_calculation(
     db.delete(calculation)
     db.commit()
     return None
+
+
+def process_calculation_batch(items: list, db: Session, user_id: int) -> list:
+    """Validate, compute and insert a batch of streamed calculations in one commit.
+
+    Returns one reply per item, in order, echoing the client's "ref".
+    """
+    replies = []
+    rows = []
+    for item in items:
+        ref = item.get("ref") if isinstance(item, dict) else None
+        if item is INVALID_JSON:
+            replies.append({"ref": None, "error": "Invalid JSON"})
+            continue
+        if not isinstance(item, dict):
+            replies.append({"ref": None, "error": "Expected a calculation object"})
+            continue
+        try:
+            calculation = CalculationCreate.model_validate(item)
+            values = calculation_values(calculation)
+        except ValidationError as exc:
+            replies.append({"ref": ref, "error": "; ".join(error["msg"] for error in exc.errors())})
+            continue
+        except HTTPException as exc:
+            replies.append({"ref": ref, "error": exc.detail})
+            continue
+        row = Calculation(user_id=user_id, **values)
+        rows.append(row)
+        replies.append({"ref": ref, "row": row})
+
+    if rows:
+        try:
+            db.add_all(rows)
+            db.commit()
+        except Exception:
+            db.rollback()
+            return [{"ref": reply["ref"], "error": reply.get("error", "Failed to save calculation")}
+                    for reply in replies]
+
+    for reply in replies:
+        row = reply.pop("row", None)
+        if row is not None:
+            reply.update(CalculationResponse.model_validate(row).model_dump(mode="json"))
+    return replies
+
+
+# Stream - WebSocket /calculations/ws?token=<access token>
+@router.websocket("/ws")
+async def calculations_websocket(
+    websocket: WebSocket,
+    token: str = Query(...),
+    db: Session = Depends(get_db)
+):
+    """Submit calculations over a single authenticated connection.
+
+    Each message is a calculation object (or a list of them) with an optional
+    "ref" that is echoed in the reply. Clients may pipeline freely: queued
+    messages are inserted in batches, and reading pauses once WS_MAX_IN_FLIGHT
+    messages are waiting, which pushes back on the sender.
+    """
+    try:
+        user = await run_in_threadpool(get_user_from_token, token, db)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+    user_id = user.id
+    # Return the connection to the pool while the socket is idle
+    db.close()
+    await websocket.accept()
+
+    pending: asyncio.Queue = asyncio.Queue(maxsize=WS_MAX_IN_FLIGHT)
+
+    async def read_messages():
+        try:
+            while True:
+                text = await websocket.receive_text()
+                try:
+                    message = json.loads(text)
+                except json.JSONDecodeError:
+                    message = INVALID_JSON
+                for item in message if isinstance(message, list) else [message]:
+                    await pending.put(item)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            await pending.put(_CLOSED)
+
+    reader = asyncio.create_task(read_messages())
+    try:
+        closed = False
+        while not closed:
+            item = await pending.get()
+            if item is _CLOSED:
+                break
+            batch = [item]
+            while len(batch) < WS_MAX_BATCH and not pending.empty():
+                item = pending.get_nowait()
+                if item is _CLOSED:
+                    closed = True
+                    break
+                batch.append(item)
+            replies = await run_in_threadpool(process_calculation_batch, batch, db, user_id)
+            for reply in replies:
+                await websocket.send_text(json.dumps(reply))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        reader.cancel()
@@ -0,0 +1,132 @@
+import csv
+import io
+import json
+import os
+
+from fastapi import APIRouter, Depends, File, HTTPException, UploadFile, status
+from fastapi.responses import FileResponse
+from sqlalchemy.orm import Session
+
+from app.database import get_db, User, CalculationJob
+from app.schemas import CalculationJobCreate, CalculationJobResponse
+from app.auth import get_current_user
+from app.jobs import get_job_runner
+
+router = APIRouter(prefix="/calculations/jobs", tags=["Calculation Jobs"])
+
+
+def job_response(job: CalculationJob) -> CalculationJobResponse:
+    return CalculationJobResponse(
+        id=job.id,
+        status=job.status,
+        total=job.total,
+        processed=job.processed,
+        failed=job.failed,
+        results_url=f"/calculations/jobs/{job.id}/results" if job.results_path else None,
+        error=job.error,
+        created_at=job.created_at,
+        updated_at=job.updated_at
+    )
+
+
+def submit_job(items: list, db: Session, current_user: User) -> CalculationJobResponse:
+    """Persist a job and hand it to the local worker pool"""
+    job = CalculationJob(
+        user_id=current_user.id,
+        payload=json.dumps(items),
+        total=len(items)
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    get_job_runner(db.get_bind()).enqueue(job.id)
+    return job_response(job)
+
+
+def parse_upload(content: bytes, filename: str) -> list:
+    """Read calculation requests from an uploaded CSV or NDJSON file"""
+    try:
+        text = content.decode("utf-8")
+        if filename.lower().endswith(".csv"):
+            return [dict(row) for row in csv.DictReader(io.StringIO(text))]
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    except (UnicodeDecodeError, csv.Error, json.JSONDecodeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Upload must be a UTF-8 CSV file or NDJSON (one calculation per line)"
+        )
+
+
+# Submit job - POST /calculations/jobs
+@router.post("", response_model=CalculationJobResponse, status_code=status.HTTP_202_ACCEPTED)
+def create_job(
+    job: CalculationJobCreate,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Queue a large batch of calculations for background processing"""
+    return submit_job(job.calculations, db, current_user)
+
+
+# Submit job from file - POST /calculations/jobs/upload
+@router.post("/upload", response_model=CalculationJobResponse, status_code=status.HTTP_202_ACCEPTED)
+def upload_job(
+    file: UploadFile = File(...),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Queue calculations from an uploaded CSV (operation,operand1,operand2) or NDJSON file"""
+    items = parse_upload(file.file.read(), file.filename or "")
+    if not items:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Upload contains no calculations"
+        )
+    return submit_job(items, db, current_user)
+
+
+def get_user_job(job_id: int, db: Session, current_user: User) -> CalculationJob:
+    job = db.query(CalculationJob).filter(
+        CalculationJob.id == job_id,
+        CalculationJob.user_id == current_user.id
+    ).first()
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job not found"
+        )
+    return job
+
+
+# Job status - GET /calculations/jobs/{id}
+@router.get("/{job_id}", response_model=CalculationJobResponse)
+def get_job(
+    job_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Report progress of a calculation job"""
+    return job_response(get_user_job(job_id, db, current_user))
+
+
+# Job results - GET /calculations/jobs/{id}/results
+@router.get("/{job_id}/results")
+def get_job_results(
+    job_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Download per-item job results as NDJSON (index, id/result or error)"""
+    job = get_user_job(job_id, db, current_user)
+    if not job.results_path:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job has no results yet"
+        )
+    if not os.path.exists(job.results_path):
+        # The job ran, but its results file is gone (e.g. JOB_RESULTS_DIR was wiped)
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Job results are no longer available"
+        )
+    return FileResponse(job.results_path, media_type="application/x-ndjson")
@@ -1,7 +1,9 @@
-from pydantic import BaseModel, EmailStr, Field
-from typing import Optional
+from pydantic import BaseModel, EmailStr, Field, field_validator, model_validator
+from typing import Any, Dict, List, Optional
 from datetime import datetime
 
+from app.expressions import EXPRESSION_MAX_BINDINGS, EXPRESSION_MAX_LENGTH, ExpressionError, compile_expression
+
 
 # User Schemas
 class UserBase(BaseModel):
@@ -24,6 +26,11 @@ class UserResponse(UserBase):
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 
 class TokenData(BaseModel):
@@ -31,20 +38,49 @@ class TokenData(BaseModel):
 
 
 # Calculation Schemas
+OPERATION_PATTERN = "^(add|subtract|multiply|divide|expression)$"
+
+
+def _check_expression(value: Optional[str]) -> Optional[str]:
+    if value is not None:
+        try:
+            compile_expression(value)
+        except ExpressionError as exc:
+            raise ValueError(str(exc))
+    return value
+
+
 class CalculationBase(BaseModel):
-    operation: str = Field(..., pattern="^(add|subtract|multiply|divide)$")
-    operand1: float
-    operand2: float
+    operation: str = Field(..., pattern=OPERATION_PATTERN)
+    # operand1/operand2 for the arithmetic operations, expression/variables
+    # for "expression"
+    operand1: Optional[float] = None
+    operand2: Optional[float] = None
+    expression: Optional[str] = Field(None, max_length=EXPRESSION_MAX_LENGTH)
+    variables: Optional[Dict[str, float]] = None
 
 
 class CalculationCreate(CalculationBase):
-    pass
+    check_expression = field_validator("expression")(_check_expression)
+
+    @model_validator(mode="after")
+    def check_inputs(self):
+        if self.operation == "expression":
+            if self.expression is None:
+                raise ValueError("expression is required for the expression operation")
+        elif self.operand1 is None or self.operand2 is None:
+            raise ValueError(f"operand1 and operand2 are required for {self.operation}")
+        return self
 
 
 class CalculationUpdate(BaseModel):
-    operation: Optional[str] = Field(None, pattern="^(add|subtract|multiply|divide)$")
+    operation: Optional[str] = Field(None, pattern=OPERATION_PATTERN)
     operand1: Optional[float] = None
     operand2: Optional[float] = None
+    expression: Optional[str] = Field(None, max_length=EXPRESSION_MAX_LENGTH)
+    variables: Optional[Dict[str, float]] = None
+
+    check_expression = field_validator("expression")(_check_expression)
 
 
 class CalculationResponse(CalculationBase):
@@ -56,3 +92,62 @@ class CalculationResponse(CalculationBase):
     
     class Config:
         from_attributes = True
+
+
+class CalculationFilter(BaseModel):
+    ids: Optional[List[int]] = None
+    operation: Optional[str] = Field(None, pattern=OPERATION_PATTERN)
+    created_from: Optional[datetime] = None
+    created_to: Optional[datetime] = None
+
+
+class BulkUpdateResult(BaseModel):
+    matched: int
+    updated: int
+    division_by_zero: List[int]  # ids left unchanged because the new result would divide by zero
+    skipped_expressions: int
+
+
+class BulkDeleteResult(BaseModel):
+    deleted: int
+
+
+class CalculationChanges(BaseModel):
+    changes: List[CalculationResponse]
+    deleted: List[int]
+    next_token: str
+    has_more: bool
+
+
+class ExpressionEvaluate(BaseModel):
+    expression: str = Field(..., max_length=EXPRESSION_MAX_LENGTH)
+    bindings: List[Dict[str, float]] = Field(..., min_length=1, max_length=EXPRESSION_MAX_BINDINGS)
+
+    check_expression = field_validator("expression")(_check_expression)
+
+
+class BindingError(BaseModel):
+    index: int
+    error: str
+
+
+class ExpressionResults(BaseModel):
+    results: List[Optional[float]]
+    errors: List[BindingError]
+
+
+# Calculation Job Schemas
+class CalculationJobCreate(BaseModel):
+    calculations: List[Dict[str, Any]] = Field(..., min_length=1)
+
+
+class CalculationJobResponse(BaseModel):
+    id: int
+    status: str
+    total: int
+    processed: int
+    failed: int
+    results_url: Optional[str] = None
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
@@ -0,0 +1,462 @@
+"""
+Horizontal sharding of users and their data across several databases.
+
+Each user lives entirely on one shard: the `users` row and everything that
+references it (calculations, tombstones, jobs, refresh tokens, retention
+policy). A separate directory database holds what must be global:
+
+- `user_directory`: user id allocation, username/email uniqueness and the
+  shard each user currently lives on
+- `id_blocks`: blocks of calculation and job ids leased to API processes
+  (hi/lo), so those ids stay unique across shards and rows can move between
+  shards without being renumbered
+
+New users are placed with a consistent-hash ring over the shard names, so
+adding a shard only remaps about 1/N of the placements; the directory entry,
+not the ring, is authoritative, which lets users be moved at any time.
+
+Configuration:
+
+    SHARD_URLS="shard0=postgresql://.../calc0,shard1=postgresql://.../calc1"
+    SHARD_DIRECTORY_URL=postgresql://.../directory   # defaults to DATABASE_URL
+
+Requests get an unbound session from `get_db`; `get_current_user` (and the
+login/refresh routes) bind it to the user's shard. Moving users:
+
+    python -m app.sharding move --user alice --to shard1
+    python -m app.sharding rebalance          # after adding a shard
+"""
+import argparse
+import bisect
+import hashlib
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import (Column, Integer, BigInteger, String, event, delete, select, update, insert,
+                        func)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session, sessionmaker
+from dotenv import load_dotenv
+
+from app.database import (DATABASE_URL, Base, SessionLocal, engine as default_engine, make_engine, User,
+                          Calculation, CalculationJob, CalculationTombstone, RefreshToken, RetentionPolicy)
+
+load_dotenv()
+
+SHARD_URLS = os.getenv("SHARD_URLS", "")
+SHARD_DIRECTORY_URL = os.getenv("SHARD_DIRECTORY_URL", DATABASE_URL)
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", "64"))
+ID_BLOCK_SIZE = int(os.getenv("ID_BLOCK_SIZE", "1000"))
+MOVE_BATCH_SIZE = 1000
+MOVE_MAX_PASSES = 10
+
+DirectoryBase = declarative_base()
+
+
+class UserDirectoryEntry(DirectoryBase):
+    __tablename__ = "user_directory"
+
+    user_id = Column(Integer, primary_key=True)
+    username = Column(String, unique=True, nullable=False)
+    email = Column(String, unique=True, nullable=False)
+    shard = Column(String, nullable=False)
+
+
+class IdBlock(DirectoryBase):
+    __tablename__ = "id_blocks"
+
+    name = Column(String, primary_key=True)
+    next_id = Column(BigInteger, nullable=False, default=1)
+
+
+# Tables whose ids are allocated globally, by the ORM class they belong to
+GLOBAL_ID_TABLES = {Calculation: "calculations", CalculationJob: "calculation_jobs"}
+
+
+class DirectoryConflict(Exception):
+    def __init__(self, field: str):
+        super().__init__(f"{field} already registered")
+        self.field = field
+
+
+class HashRing:
+    """Consistent-hash ring with virtual nodes"""
+
+    def __init__(self, nodes: List[str], vnodes: int = SHARD_VNODES):
+        self._ring: List[Tuple[int, str]] = sorted(
+            (self._hash(f"{node}#{replica}"), node) for node in nodes for replica in range(vnodes)
+        )
+        self._keys = [key for key, _ in self._ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+    def node_for(self, key) -> str:
+        index = bisect.bisect(self._keys, self._hash(str(key))) % len(self._ring)
+        return self._ring[index][1]
+
+
+class IdAllocator:
+    """Hands out ids from blocks leased from the directory (hi/lo)"""
+
+    def __init__(self, directory_engine, block_size: int = ID_BLOCK_SIZE):
+        self.directory_engine = directory_engine
+        self.block_size = block_size
+        self._blocks: Dict[str, List[int]] = {}  # name -> [next, end)
+        self._lock = threading.Lock()
+
+    def _lease(self, name: str) -> List[int]:
+        table = IdBlock.__table__
+        with self.directory_engine.begin() as connection:
+            end = connection.execute(
+                update(table).where(table.c.name == name)
+                .values(next_id=table.c.next_id + self.block_size)
+                .returning(table.c.next_id)
+            ).scalar()
+            if end is None:
+                end = 1 + self.block_size
+                connection.execute(insert(table).values(name=name, next_id=end))
+        return [end - self.block_size, end]
+
+    def next_id(self, name: str) -> int:
+        with self._lock:
+            block = self._blocks.get(name)
+            if block is None or block[0] >= block[1]:
+                block = self._blocks[name] = self._lease(name)
+            block[0] += 1
+            return block[0] - 1
+
+
+class ShardRouter:
+    def __init__(self, shard_urls: Dict[str, str], directory_url: str):
+        self.engines = {name: make_engine(url) for name, url in shard_urls.items()}
+        self.directory_engine = make_engine(directory_url)
+        self.ring = HashRing(sorted(self.engines))
+        self.ids = IdAllocator(self.directory_engine)
+        self._shard_names = {engine: name for name, engine in self.engines.items()}
+        self._session_factory = sessionmaker(autocommit=False, autoflush=False)
+        self._directory_session = sessionmaker(autocommit=False, autoflush=False, bind=self.directory_engine)
+
+    def create_all(self):
+        DirectoryBase.metadata.create_all(bind=self.directory_engine)
+        for shard_engine in self.engines.values():
+            Base.metadata.create_all(bind=shard_engine)
+
+    def dispose(self):
+        for shard_engine in [*self.engines.values(), self.directory_engine]:
+            shard_engine.dispose()
+
+    def owns(self, bind) -> bool:
+        return bind in self._shard_names
+
+    def session(self) -> Session:
+        """An unbound session; bind it with `bind_user` or `bind_shard`"""
+        return self._session_factory()
+
+    def bind_shard(self, db: Session, shard: str):
+        db.bind = self.engines[shard]
+
+    def shard_of(self, db: Session) -> Optional[str]:
+        return self._shard_names.get(db.bind)
+
+    def lookup(self, username: str) -> Optional[UserDirectoryEntry]:
+        with self._directory_session() as directory:
+            return directory.query(UserDirectoryEntry).filter(UserDirectoryEntry.username == username).first()
+
+    def lookup_id(self, user_id: int) -> Optional[UserDirectoryEntry]:
+        with self._directory_session() as directory:
+            return directory.get(UserDirectoryEntry, user_id)
+
+    def bind_user(self, db: Session, username: str) -> bool:
+        """Bind a request session to a user's shard; False for unknown users"""
+        entry = self.lookup(username)
+        if entry is None:
+            return False
+        self.bind_shard(db, entry.shard)
+        return True
+
+    def bind_refresh_token(self, db: Session, refresh_token: str):
+        """Bind to the shard holding a refresh token (any shard if none does)"""
+        token_id = refresh_token.partition(".")[0]
+        for shard, shard_engine in self.engines.items():
+            with shard_engine.connect() as connection:
+                found = connection.execute(
+                    select(RefreshToken.id).where(RefreshToken.id == token_id)
+                ).first()
+            if found is not None:
+                self.bind_shard(db, shard)
+                return
+        self.bind_shard(db, next(iter(self.engines)))
+
+    def taken_field(self, username: str, email: str) -> Optional[str]:
+        with self._directory_session() as directory:
+            entry = directory.query(UserDirectoryEntry).filter(
+                (UserDirectoryEntry.username == username) | (UserDirectoryEntry.email == email)
+            ).first()
+        if entry is None:
+            return None
+        return "username" if entry.username == username else "email"
+
+    def register_user(self, db: Session, username: str, email: str, hashed_password: str) -> User:
+        """Reserve the username/email globally, then create the user on its shard"""
+        with self._directory_session() as directory:
+            entry = UserDirectoryEntry(username=username, email=email, shard="")
+            directory.add(entry)
+            try:
+                directory.flush()
+            except IntegrityError:
+                directory.rollback()
+                raise DirectoryConflict(self.taken_field(username, email) or "username")
+            entry.shard = self.ring.node_for(entry.user_id)
+            directory.commit()
+            user_id, shard = entry.user_id, entry.shard
+
+        self.bind_shard(db, shard)
+        user = User(id=user_id, username=username, email=email, hashed_password=hashed_password)
+        db.add(user)
+        try:
+            db.commit()
+        except Exception:
+            db.rollback()
+            with self._directory_session() as directory:
+                directory.query(UserDirectoryEntry).filter(UserDirectoryEntry.user_id == user_id).delete()
+                directory.commit()
+            raise
+        db.refresh(user)
+        return user
+
+    def register_users(self, rows: List[dict]) -> int:
+        """Bulk `register_user`: reserve directory entries in one statement, then insert per shard.
+
+        Rows are `users` column values without ids. Raises IntegrityError,
+        leaving nothing behind, if any username or email is already taken.
+        """
+        table = UserDirectoryEntry.__table__
+        with self.directory_engine.begin() as connection:
+            user_ids = connection.execute(
+                insert(table).returning(table.c.user_id, sort_by_parameter_order=True),
+                [{"username": row["username"], "email": row["email"], "shard": ""} for row in rows]
+            ).scalars().all()
+            by_shard: Dict[str, List[dict]] = {}
+            for row, user_id in zip(rows, user_ids):
+                by_shard.setdefault(self.ring.node_for(user_id), []).append({**row, "id": user_id})
+            for shard, users in by_shard.items():
+                connection.execute(update(table).where(table.c.user_id.in_([user["id"] for user in users]))
+                                   .values(shard=shard))
+
+        written = []
+        try:
+            for shard, users in by_shard.items():
+                with self.engines[shard].begin() as connection:
+                    connection.execute(insert(User), users)
+                written.append(shard)
+        except Exception:
+            for shard in written:
+                with self.engines[shard].begin() as connection:
+                    connection.execute(delete(User).where(User.id.in_([user["id"] for user in by_shard[shard]])))
+            with self.directory_engine.begin() as connection:
+                connection.execute(delete(table).where(table.c.user_id.in_(user_ids)))
+            raise
+        return len(user_ids)
+
+
+_router: Optional[ShardRouter] = None
+
+
+def parse_shard_urls(value: str) -> Dict[str, str]:
+    shards = {}
+    for part in value.split(","):
+        if part.strip():
+            name, _, url = part.strip().partition("=")
+            shards[name.strip()] = url.strip()
+    return shards
+
+
+def get_shard_router() -> Optional[ShardRouter]:
+    """The configured router, or None when sharding is off"""
+    if _router is None and SHARD_URLS:
+        set_shard_router(ShardRouter(parse_shard_urls(SHARD_URLS), SHARD_DIRECTORY_URL))
+    return _router
+
+
+def data_engines() -> List:
+    """Engines holding user data: every shard, or the default engine when sharding is off"""
+    router = get_shard_router()
+    return list(router.engines.values()) if router is not None else [default_engine]
+
+
+def set_shard_router(router: Optional[ShardRouter]):
+    global _router
+    _router = router
+    # Request sessions start unbound while sharding is on
+    SessionLocal.configure(bind=None if router is not None else default_engine)
+
+
+@event.listens_for(Session, "before_flush")
+def _assign_global_ids(session, flush_context, instances):
+    if _router is None or not _router.owns(session.bind):
+        return
+    for obj in session.new:
+        name = GLOBAL_ID_TABLES.get(type(obj))
+        if name is not None and obj.id is None:
+            obj.id = _router.ids.next_id(name)
+
+
+def _copy_rows(target, table, rows, keep_ids: bool = True):
+    """Insert rows into the target; ids are kept only where they are globally unique"""
+    if not rows:
+        return
+    if keep_ids:
+        target.execute(delete(table).where(table.c.id.in_([row["id"] for row in rows])))
+    else:
+        rows = [{key: value for key, value in row.items() if key != "id"} for row in rows]
+    target.execute(insert(table), rows)
+
+
+def _copy_changes(source, target, user_id: int, since: int, batch_size: int) -> Tuple[int, int]:
+    """Apply a user's changes in (since, current change_seq]; returns (rows applied, new checkpoint)"""
+    users = User.__table__
+    calculations = Calculation.__table__
+    tombstones = CalculationTombstone.__table__
+    # Only committed sequence numbers are visible, so nothing at or below
+    # `upper` can still appear later
+    upper = source.execute(select(users.c.change_seq).where(users.c.id == user_id)).scalar_one()
+    applied = 0
+    checkpoint = since
+    while True:
+        rows = [dict(row) for row in source.execute(
+            select(calculations).where(
+                calculations.c.user_id == user_id,
+                calculations.c.change_seq > checkpoint,
+                calculations.c.change_seq <= upper
+            ).order_by(calculations.c.change_seq).limit(batch_size)
+        ).mappings()]
+        _copy_rows(target, calculations, rows)
+        applied += len(rows)
+        if len(rows) < batch_size:
+            break
+        checkpoint = rows[-1]["change_seq"]
+    removed = [dict(row) for row in source.execute(
+        select(tombstones).where(
+            tombstones.c.user_id == user_id,
+            tombstones.c.change_seq > since,
+            tombstones.c.change_seq <= upper
+        )
+    ).mappings()]
+    if removed:
+        target.execute(delete(calculations).where(
+            calculations.c.id.in_([row["calculation_id"] for row in removed])
+        ))
+        _copy_rows(target, tombstones, removed, keep_ids=False)
+        applied += len(removed)
+    return applied, upper
+
+
+def move_user(router: ShardRouter, user_id: int, target_shard: str, batch_size: int = MOVE_BATCH_SIZE) -> int:
+    """Move a user and their data to another shard while they stay online.
+
+    Rows are copied in change_seq order and re-copied until the delta is
+    small; only the final pass runs with the user's row locked on the
+    source, which blocks that user's writers for a moment. Writes that
+    resolved the old shard before the switch fail and can be retried.
+    Returns the number of rows copied.
+    """
+    entry = router.lookup_id(user_id)
+    if entry is None:
+        raise ValueError(f"unknown user id {user_id}")
+    if entry.shard == target_shard:
+        return 0
+    source_engine, target_engine = router.engines[entry.shard], router.engines[target_shard]
+    users = User.__table__
+    jobs = CalculationJob.__table__
+
+    with source_engine.connect() as source:
+        active = source.execute(select(func.count()).select_from(jobs).where(
+            jobs.c.user_id == user_id, jobs.c.status.in_(("pending", "running"))
+        )).scalar()
+    if active:
+        raise ValueError(f"user {user_id} has {active} unfinished jobs")
+
+    # Online copy: the user keeps writing to the source meanwhile
+    with source_engine.connect() as source, target_engine.begin() as target:
+        user_row = dict(source.execute(select(users).where(users.c.id == user_id)).mappings().one())
+        target.execute(delete(users).where(users.c.id == user_id))
+        target.execute(insert(users), [dict(user_row, change_seq=0)])
+    copied, checkpoint = 0, -1
+    for _ in range(MOVE_MAX_PASSES):
+        with source_engine.connect() as source, target_engine.begin() as target:
+            applied, checkpoint = _copy_changes(source, target, user_id, checkpoint, batch_size)
+        copied += applied
+        if applied < batch_size:
+            break
+
+    # Cut-over: lock the user on the source, apply the last changes, switch
+    with source_engine.begin() as source:
+        source.execute(update(users).where(users.c.id == user_id).values(change_seq=users.c.change_seq))
+        with target_engine.begin() as target:
+            applied, checkpoint = _copy_changes(source, target, user_id, checkpoint, batch_size)
+            copied += applied
+            user_row = dict(source.execute(select(users).where(users.c.id == user_id)).mappings().one())
+            target.execute(update(users).where(users.c.id == user_id).values(**user_row))
+            for model in (CalculationJob, RefreshToken, RetentionPolicy):
+                table = model.__table__
+                rows = [dict(row) for row in source.execute(
+                    select(table).where(table.c.user_id == user_id)
+                ).mappings()]
+                _copy_rows(target, table, rows, keep_ids=model is not RetentionPolicy)
+                copied += len(rows)
+
+        with router._directory_session() as directory:
+            directory.query(UserDirectoryEntry).filter(UserDirectoryEntry.user_id == user_id).update(
+                {"shard": target_shard}
+            )
+            directory.commit()
+
+        for model in (Calculation, CalculationTombstone, CalculationJob, RefreshToken, RetentionPolicy, User):
+            table = model.__table__
+            column = table.c.id if model is User else table.c.user_id
+            source.execute(delete(table).where(column == user_id))
+    return copied
+
+
+def rebalance(router: ShardRouter) -> int:
+    """Move every user whose ring placement differs from their shard"""
+    moved = 0
+    with router._directory_session() as directory:
+        entries = [(entry.user_id, entry.shard) for entry in directory.query(UserDirectoryEntry)]
+    for user_id, shard in entries:
+        target = router.ring.node_for(user_id)
+        if target != shard:
+            move_user(router, user_id, target)
+            moved += 1
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move users between shards")
+    commands = parser.add_subparsers(dest="command", required=True)
+    move = commands.add_parser("move", help="move one user to a shard")
+    move.add_argument("--user", required=True, help="username")
+    move.add_argument("--to", required=True, help="target shard name")
+    commands.add_parser("rebalance", help="move users to their consistent-hash placement")
+    args = parser.parse_args()
+
+    router = get_shard_router()
+    if router is None:
+        parser.error("SHARD_URLS is not set")
+    router.create_all()
+    if args.command == "move":
+        entry = router.lookup(args.user)
+        if entry is None:
+            parser.error(f"unknown user {args.user}")
+        count = move_user(router, entry.user_id, args.to)
+        print(f"Moved {args.user} from {entry.shard} to {args.to} ({count} rows)")
+    else:
+        print(f"Moved {rebalance(router)} users")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+In-memory static asset cache for the bundled web UI.
+
+At startup every small file in `static/` is read once, together with gzip
+and (if the optional `brotli` package is installed) brotli variants. Files
+already precompressed on disk (`app.js.gz`, `app.js.br`) are used as-is
+unless they are older than their source, which is then compressed again.
+
+`app.js` and `styles.css` are additionally served under content-hashed names
+(`app.<hash>.js`) with far-future immutable caching, and `index.html` is
+rewritten to reference them, so browsers re-download an asset only when its
+content changes. `index.html` itself is revalidated with its ETag.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+from typing import Dict, Optional
+
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+
+from app.compression import brotli
+
+HASHED_ASSETS = ("app.js", "styles.css")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+MAX_CACHED_ASSET_BYTES = 1024 * 1024
+
+
+class Asset:
+    def __init__(self, content: bytes, media_type: str, cache_control: str, variants: Dict[str, bytes]):
+        self.content = content
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.variants = variants
+        self.etag = '"' + hashlib.sha256(content).hexdigest()[:32] + '"'
+
+    def response(self, request_headers: Headers) -> Response:
+        headers = {
+            "Cache-Control": self.cache_control,
+            "ETag": self.etag,
+            "Vary": "Accept-Encoding",
+        }
+        if self.etag in request_headers.get("If-None-Match", ""):
+            return Response(status_code=304, headers=headers)
+        body = self.content
+        accepted = _accepted_encodings(request_headers.get("Accept-Encoding", ""))
+        for encoding in ("br", "gzip"):
+            if encoding in accepted and encoding in self.variants:
+                body = self.variants[encoding]
+                headers["Content-Encoding"] = encoding
+                break
+        return Response(content=body, media_type=self.media_type, headers=headers)
+
+
+def _accepted_encodings(accept_encoding: str) -> set:
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        if params.strip() in ("q=0", "q=0.0"):
+            continue
+        accepted.add(coding.strip())
+    return accepted
+
+
+def _variants(content: bytes, path: Optional[str] = None) -> Dict[str, bytes]:
+    variants = {}
+    for encoding, suffix in (("gzip", ".gz"), ("br", ".br")):
+        # A precompressed file older than its source was left behind by an edit
+        if path is not None and os.path.exists(path + suffix) \
+                and os.stat(path + suffix).st_mtime >= os.stat(path).st_mtime:
+            with open(path + suffix, "rb") as precompressed:
+                variants[encoding] = precompressed.read()
+    if "gzip" not in variants:
+        variants["gzip"] = gzip.compress(content, compresslevel=9, mtime=0)
+    if "br" not in variants and brotli is not None:
+        variants["br"] = brotli.compress(content, quality=11)
+    # Keep a variant only if it is actually smaller
+    return {encoding: data for encoding, data in variants.items() if len(data) < len(content)}
+
+
+def _hashed_name(name: str, content: bytes) -> str:
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(content).hexdigest()[:12]}{ext}"
+
+
+class StaticAssetCache:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.assets: Dict[str, Asset] = {}
+        self.index: Optional[Asset] = None
+        self.loaded = False
+
+    def load(self):
+        assets = {}
+        hashed_names = {}
+        index_html = None
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if name.endswith((".gz", ".br")) or not os.path.isfile(path):
+                continue
+            if os.path.getsize(path) > MAX_CACHED_ASSET_BYTES:
+                continue
+            with open(path, "rb") as asset_file:
+                content = asset_file.read()
+            if name == "index.html":
+                index_html = content
+                continue
+            media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            variants = _variants(content, path)
+            assets[name] = Asset(content, media_type, REVALIDATE_CACHE_CONTROL, variants)
+            if name in HASHED_ASSETS:
+                hashed = _hashed_name(name, content)
+                hashed_names[name] = hashed
+                assets[hashed] = Asset(content, media_type, IMMUTABLE_CACHE_CONTROL, variants)
+
+        index = None
+        if index_html is not None:
+            html = index_html.decode("utf-8")
+            for name, hashed in hashed_names.items():
+                html = html.replace(f"/static/{name}", f"/static/{hashed}")
+            content = html.encode("utf-8")
+            # Rewritten in memory, so precompressed copies on disk would be stale
+            index = Asset(content, "text/html; charset=utf-8", REVALIDATE_CACHE_CONTROL, _variants(content))
+
+        self.assets = assets
+        self.index = index
+        self.loaded = True
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles that serves cached assets from memory and falls back to disk"""
+
+    def __init__(self, cache: StaticAssetCache, **kwargs):
+        super().__init__(directory=cache.directory, **kwargs)
+        self.cache = cache
+
+    async def get_response(self, path: str, scope) -> Response:
+        self.cache.ensure_loaded()
+        asset = self.cache.assets.get(path)
+        if asset is not None and scope["method"] in ("GET", "HEAD"):
+            return asset.response(Headers(scope=scope))
+        return await super().get_response(path, scope)
@@ -0,0 +1,333 @@
+"""
+Lightweight request tracing without an external collector.
+
+With `TRACING_ENABLED=true` every HTTP request gets a root span, and the
+phases inside it become child spans: authentication, DB session acquisition,
+every SQL statement, `calculate_result` and response serialization. Trace
+context is read from and written to the W3C `traceparent` header, so a trace
+can be continued by (or from) another service.
+
+Finished traces are handed to an exporter:
+
+- `TRACE_EXPORTER=file` (default) appends one OTLP/JSON `resourceSpans`
+  document per request to `TRACE_FILE`, the same line format as the
+  OpenTelemetry Collector file exporter, so the output can be replayed into
+  any OTLP-compatible backend or analysed with jq/pandas.
+- `TRACE_EXPORTER=memory` keeps the most recent spans in memory
+  (`get_span_exporter().get_finished_spans()`).
+
+Outside a traced request `span()` is a no-op, and the middleware and SQL
+hooks are only installed when tracing is enabled.
+"""
+import functools
+import inspect
+import json
+import os
+import re
+import secrets
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() == "true"
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "file")
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_MEMORY_SPANS = int(os.getenv("TRACE_MEMORY_SPANS", "10000"))
+SERVICE_NAME = os.getenv("SERVICE_NAME", "calculations-api")
+MAX_STATEMENT_LENGTH = 2000
+
+# OTLP enums
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+STATUS_UNSET = 0
+STATUS_ERROR = 2
+
+TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+def _attribute_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Trace:
+    """Spans of one request, exported together when the root span ends"""
+
+    def __init__(self, trace_id: str, sampled: bool = True):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans: List["Span"] = []
+        self._lock = threading.Lock()
+
+    def add(self, span: "Span"):
+        with self._lock:
+            self.spans.append(span)
+
+
+class Span:
+    def __init__(self, trace: Trace, name: str, parent_span_id: Optional[str] = None,
+                 kind: int = SPAN_KIND_INTERNAL, attributes: Optional[Dict[str, Any]] = None):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_span_id = parent_span_id
+        self.name = name
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.status_code = STATUS_UNSET
+        self.status_message = ""
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def record_error(self, exc: BaseException):
+        self.status_code = STATUS_ERROR
+        self.status_message = f"{type(exc).__name__}: {exc}"
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            self.trace.add(self)
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_otlp(self) -> dict:
+        data = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": key, "value": _attribute_value(value)} for key, value in self.attributes.items()],
+            "status": {"code": self.status_code},
+        }
+        if self.parent_span_id:
+            data["parentSpanId"] = self.parent_span_id
+        if self.status_message:
+            data["status"]["message"] = self.status_message
+        return data
+
+
+class InMemorySpanExporter:
+    def __init__(self, max_spans: int = TRACE_MEMORY_SPANS):
+        self._spans = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+
+    def export(self, spans: List[Span]):
+        with self._lock:
+            self._spans.extend(spans)
+
+    def get_finished_spans(self) -> List[Span]:
+        with self._lock:
+            return list(self._spans)
+
+    def clear(self):
+        with self._lock:
+            self._spans.clear()
+
+
+class FileSpanExporter:
+    """Append OTLP/JSON lines, one `resourceSpans` document per trace"""
+
+    def __init__(self, path: str = TRACE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans: List[Span]):
+        document = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": _attribute_value(SERVICE_NAME)}]},
+            "scopeSpans": [{"scope": {"name": "app.tracing"}, "spans": [span.to_otlp() for span in spans]}],
+        }]}
+        line = json.dumps(document, separators=(",", ":")) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as trace_file:
+                trace_file.write(line)
+
+
+_exporter = None
+
+
+def get_span_exporter():
+    global _exporter
+    if _exporter is None:
+        _exporter = InMemorySpanExporter() if TRACE_EXPORTER == "memory" else FileSpanExporter()
+    return _exporter
+
+
+def set_span_exporter(exporter):
+    global _exporter
+    _exporter = exporter
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def start_span(name: str, kind: int = SPAN_KIND_INTERNAL, **attributes) -> Optional[Span]:
+    """Start a child of the current span without making it current"""
+    parent = _current_span.get()
+    if parent is None:
+        return None
+    return Span(parent.trace, name, parent.span_id, kind, attributes)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Trace a block as a child of the current span; a no-op outside a trace"""
+    child = start_span(name, **attributes)
+    if child is None:
+        yield None
+        return
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as exc:
+        child.record_error(exc)
+        raise
+    finally:
+        _current_span.reset(token)
+        child.end()
+
+
+def traced(name: str):
+    """Decorator form of `span()` for plain and async functions"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if _current_span.get() is None:
+                    return await func(*args, **kwargs)
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current_span.get() is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def parse_traceparent(header: Optional[str]):
+    """Return (trace id, parent span id, sampled) from a traceparent header, or None"""
+    if not header:
+        return None
+    match = TRACEPARENT_RE.match(header.strip().lower())
+    if match is None or match.group(1) == "0" * 32 or match.group(2) == "0" * 16:
+        return None
+    return match.group(1), match.group(2), bool(int(match.group(3), 16) & 1)
+
+
+class TracingMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        incoming = parse_traceparent(Headers(scope=scope).get("traceparent"))
+        if incoming is not None:
+            trace_id, parent_span_id, sampled = incoming
+        else:
+            trace_id, parent_span_id, sampled = secrets.token_hex(16), None, True
+        root = Span(Trace(trace_id, sampled), f"{scope['method']} {scope['path']}", parent_span_id,
+                    SPAN_KIND_SERVER, {"http.method": scope["method"], "http.target": scope["path"]})
+
+        async def send_with_trace(message: Message):
+            if message["type"] == "http.response.start":
+                root.set_attribute("http.status_code", message["status"])
+                route = scope.get("route")
+                if route is not None:
+                    root.name = f"{scope['method']} {route.path}"
+                    root.set_attribute("http.route", route.path)
+                headers = MutableHeaders(raw=message["headers"])
+                headers["traceparent"] = f"00-{trace_id}-{root.span_id}-{'01' if sampled else '00'}"
+            await send(message)
+
+        token = _current_span.set(root)
+        try:
+            await self.app(scope, receive, send_with_trace)
+        except BaseException as exc:
+            root.record_error(exc)
+            raise
+        finally:
+            _current_span.reset(token)
+            root.end()
+            if sampled:
+                get_span_exporter().export(sorted(root.trace.spans, key=lambda item: item.start_ns))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    child = start_span("db.query", SPAN_KIND_CLIENT)
+    if child is not None:
+        child.set_attribute("db.system", conn.dialect.name)
+        child.set_attribute("db.statement", statement[:MAX_STATEMENT_LENGTH])
+        if executemany:
+            child.set_attribute("db.executemany", True)
+        context._trace_span = child
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    child = getattr(context, "_trace_span", None)
+    if child is not None:
+        if cursor.rowcount is not None and cursor.rowcount >= 0:
+            child.set_attribute("db.rowcount", cursor.rowcount)
+        child.end()
+        context._trace_span = None
+
+
+def _handle_error(exception_context):
+    context = exception_context.execution_context
+    child = getattr(context, "_trace_span", None) if context is not None else None
+    if child is not None:
+        child.record_error(exception_context.original_exception)
+        child.end()
+        context._trace_span = None
+
+
+_installed = False
+
+
+def install():
+    """Hook SQL execution and response serialization; safe to call twice"""
+    global _installed
+    if _installed:
+        return
+    _installed = True
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(Engine, "handle_error", _handle_error)
+
+    # FastAPI looks serialize_response up at call time, so wrapping the module
+    # attribute covers every route's response model validation and dumping
+    import fastapi.routing
+
+    fastapi.routing.serialize_response = traced("serialize_response")(fastapi.routing.serialize_response)
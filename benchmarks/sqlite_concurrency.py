@@ -0,0 +1,120 @@
+"""
+Concurrent read/write throughput on SQLite, default engine vs. the SQLite profile.
+
+Reader threads list one user's calculations; writer threads insert
+calculations through the ORM (change sequence stamping included) and commit
+each one. Both run for --seconds against a fresh database file per mode.
+
+    python benchmarks/sqlite_concurrency.py --readers 8 --writers 4 --seconds 10
+
+`default` is a plain create_engine() with pysqlite's defaults (rollback
+journal); `profile` is app.database.make_engine() (WAL, tuned pragmas and the
+in-process writer lock).
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.database import Base, Calculation, User, make_engine  # noqa: E402
+
+USERS = 20
+SEED_ROWS = 20000
+
+
+def build(mode, path):
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    url = f"sqlite:///{path}"
+    if mode == "profile":
+        return make_engine(url)
+    return create_engine(url, connect_args={"check_same_thread": False})
+
+
+def seed(Session):
+    db = Session()
+    db.add_all(User(username=f"user{i}", email=f"user{i}@example.com", hashed_password="x")
+               for i in range(1, USERS + 1))
+    db.commit()
+    rng = random.Random(1)
+    db.add_all(Calculation(user_id=rng.randint(1, USERS), operation="add", operand1=1, operand2=2, result=3)
+               for _ in range(SEED_ROWS))
+    db.commit()
+    db.close()
+
+
+def run(mode, args):
+    engine = build(mode, os.path.join(args.dir, f"{mode}.db"))
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    seed(Session)
+
+    counts = {"reads": 0, "writes": 0, "locked": 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.seconds
+
+    def bump(key):
+        with lock:
+            counts[key] += 1
+
+    def reader(seed_value):
+        rng = random.Random(seed_value)
+        db = Session()
+        while time.perf_counter() < deadline:
+            db.query(Calculation).filter(Calculation.user_id == rng.randint(1, USERS)).limit(100).all()
+            db.rollback()
+            bump("reads")
+        db.close()
+
+    def writer(seed_value):
+        rng = random.Random(seed_value)
+        db = Session()
+        while time.perf_counter() < deadline:
+            try:
+                db.add(Calculation(user_id=rng.randint(1, USERS), operation="multiply",
+                                   operand1=2, operand2=3, result=6))
+                db.commit()
+                bump("writes")
+            except OperationalError:
+                db.rollback()
+                bump("locked")
+        db.close()
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(args.readers)]
+    threads += [threading.Thread(target=writer, args=(100 + i,)) for i in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--dir", default="bench_data")
+    args = parser.parse_args()
+    os.makedirs(args.dir, exist_ok=True)
+
+    print(f"{args.readers} readers, {args.writers} writers, {args.seconds:g}s")
+    print(f"{'mode':<8} {'reads/s':>10} {'writes/s':>10} {'locked':>8}")
+    for mode in ("default", "profile"):
+        counts = run(mode, args)
+        print(f"{mode:<8} {counts['reads'] / args.seconds:>10.0f} {counts['writes'] / args.seconds:>10.0f} "
+              f"{counts['locked']:>8}")
+
+
+if __name__ == "__main__":
+    main()
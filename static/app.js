@@ -1,6 +1,10 @@
 const API_URL = window.location.origin;
 let token = localStorage.getItem('token');
+let refreshToken = localStorage.getItem('refreshToken');
+let refreshing = null;
 let currentUser = null;
+let calculations = [];
+let eventSource = null;
 
 // Tab switching
 function showTab(tabId) {
@@ -15,6 +19,53 @@ function showTab(tabId) {
     event.target.classList.add('active');
 }
 
+// Store tokens returned by /auth/token or /auth/refresh
+function saveTokens(data) {
+    token = data.access_token;
+    refreshToken = data.refresh_token;
+    localStorage.setItem('token', token);
+    localStorage.setItem('refreshToken', refreshToken);
+}
+
+// Renew the access token with the refresh token (shared by concurrent callers,
+// since each refresh token may only be used once)
+function refreshAccessToken() {
+    if (!refreshToken) {
+        return Promise.resolve(false);
+    }
+    if (!refreshing) {
+        refreshing = fetch(`${API_URL}/auth/refresh`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ refresh_token: refreshToken })
+        }).then(async (response) => {
+            if (!response.ok) {
+                return false;
+            }
+            saveTokens(await response.json());
+            return true;
+        }).catch(() => false).finally(() => {
+            refreshing = null;
+        });
+    }
+    return refreshing;
+}
+
+// Authenticated fetch; on 401 renews the access token once and retries
+async function apiFetch(url, options = {}) {
+    const withToken = () => ({
+        ...options,
+        headers: { ...(options.headers || {}), 'Authorization': `Bearer ${token}` }
+    });
+    let response = await fetch(url, withToken());
+    if (response.status === 401 && await refreshAccessToken()) {
+        response = await fetch(url, withToken());
+    }
+    return response;
+}
+
 // Show message
 function showMessage(elementId, message, isError = false) {
     const messageEl = document.getElementById(elementId);
@@ -81,8 +132,7 @@ document.getElementById('login-form').addEventListener('submit', async (e) => {
         const data = await response.json();
         
         if (response.ok) {
-            token = data.access_token;
-            localStorage.setItem('token', token);
+            saveTokens(data);
             await loadUserInfo();
             showCalculationsSection();
             showMessage('calc-message', 'Login successful!');
@@ -98,7 +148,7 @@ document.getElementById('login-form').addEventListener('submit', async (e) => {
 // Load user info
 async function loadUserInfo() {
     try {
-        const response = await fetch(`${API_URL}/auth/me`, {
+        const response = await apiFetch(`${API_URL}/auth/me`, {
             headers: {
                 'Authorization': `Bearer ${token}`
             }
@@ -118,13 +168,82 @@ function showCalculationsSection() {
     document.getElementById('auth-section').classList.add('hidden');
     document.getElementById('calculations-section').classList.remove('hidden');
     loadCalculations();
+    openEventStream();
+}
+
+// Live updates (Server-Sent Events) so the list stays in sync without reloading
+function openEventStream() {
+    closeEventStream();
+    let disconnected = false;
+    eventSource = new EventSource(`${API_URL}/calculations/events?token=${encodeURIComponent(token)}`);
+    
+    eventSource.addEventListener('created', (e) => upsertCalculation(JSON.parse(e.data)));
+    eventSource.addEventListener('updated', (e) => upsertCalculation(JSON.parse(e.data)));
+    eventSource.addEventListener('deleted', (e) => removeCalculation(JSON.parse(e.data).id));
+    eventSource.addEventListener('resync', () => loadCalculations());
+    
+    eventSource.onerror = () => {
+        disconnected = true;
+        // A rejected token closes the stream for good; renew it and reconnect
+        if (eventSource && eventSource.readyState === EventSource.CLOSED) {
+            refreshAccessToken().then((ok) => {
+                if (ok) {
+                    openEventStream();
+                }
+            });
+        }
+    };
+    eventSource.onopen = () => {
+        // Events may have been missed while reconnecting
+        if (disconnected) {
+            disconnected = false;
+            loadCalculations();
+        }
+    };
+}
+
+function closeEventStream() {
+    if (eventSource) {
+        eventSource.close();
+        eventSource = null;
+    }
+}
+
+// Apply a single created/updated calculation to the displayed list
+function upsertCalculation(calc) {
+    const index = calculations.findIndex(c => c.id === calc.id);
+    if (index === -1) {
+        calculations.push(calc);
+    } else {
+        calculations[index] = calc;
+    }
+    displayCalculations(calculations);
+}
+
+// Remove a deleted calculation from the displayed list
+function removeCalculation(id) {
+    calculations = calculations.filter(c => c.id !== id);
+    displayCalculations(calculations);
 }
 
 // Logout
 function logout() {
+    closeEventStream();
+    if (refreshToken) {
+        fetch(`${API_URL}/auth/logout`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ refresh_token: refreshToken })
+        }).catch(() => {});
+    }
     token = null;
+    refreshToken = null;
     currentUser = null;
+    calculations = [];
     localStorage.removeItem('token');
+    localStorage.removeItem('refreshToken');
     document.getElementById('auth-section').classList.remove('hidden');
     document.getElementById('calculations-section').classList.add('hidden');
     document.getElementById('calculations-list').innerHTML = '';
@@ -156,7 +275,7 @@ document.getElementById('add-calculation-form').addEventListener('submit', async
     }
     
     try {
-        const response = await fetch(`${API_URL}/calculations/`, {
+        const response = await apiFetch(`${API_URL}/calculations/`, {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
@@ -170,7 +289,7 @@ document.getElementById('add-calculation-form').addEventListener('submit', async
         if (response.ok) {
             showMessage('calc-message', `Calculation created! Result: ${data.result}`);
             document.getElementById('add-calculation-form').reset();
-            loadCalculations();
+            upsertCalculation(data);
         } else {
             showMessage('calc-message', data.detail || 'Failed to create calculation', true);
         }
@@ -182,15 +301,16 @@ document.getElementById('add-calculation-form').addEventListener('submit', async
 // Load calculations (Browse)
 async function loadCalculations() {
     try {
-        const response = await fetch(`${API_URL}/calculations/`, {
+        const response = await apiFetch(`${API_URL}/calculations/`, {
             headers: {
                 'Authorization': `Bearer ${token}`
             }
         });
         
-        const calculations = await response.json();
+        const data = await response.json();
         
         if (response.ok) {
+            calculations = data;
             displayCalculations(calculations);
         } else {
             showMessage('calc-message', 'Failed to load calculations', true);
@@ -216,11 +336,15 @@ function displayCalculations(calculations) {
             'multiply': '×',
             'divide': '÷'
         }[calc.operation];
+        // Expressions are created through the API; show the formula itself
+        const formula = calc.operation === 'expression'
+            ? calc.expression
+            : `${calc.operand1} ${operationSymbol} ${calc.operand2}`;
         
         return `
             <div class="calculation-item">
                 <div class="calculation-info">
-                    <h3>${calc.operand1} ${operationSymbol} ${calc.operand2} = ${calc.result}</h3>
+                    <h3>${formula} = ${calc.result}</h3>
                     <p><strong>Operation:</strong> ${calc.operation}</p>
                     <p><strong>Created:</strong> ${new Date(calc.created_at).toLocaleString()}</p>
                     <p><strong>Updated:</strong> ${new Date(calc.updated_at).toLocaleString()}</p>
@@ -237,7 +361,7 @@ function displayCalculations(calculations) {
 // Edit calculation
 async function editCalculation(id) {
     try {
-        const response = await fetch(`${API_URL}/calculations/${id}`, {
+        const response = await apiFetch(`${API_URL}/calculations/${id}`, {
             headers: {
                 'Authorization': `Bearer ${token}`
             }
@@ -286,7 +410,7 @@ document.getElementById('edit-calculation-form').addEventListener('submit', asyn
     }
     
     try {
-        const response = await fetch(`${API_URL}/calculations/${id}`, {
+        const response = await apiFetch(`${API_URL}/calculations/${id}`, {
             method: 'PUT',
             headers: {
                 'Content-Type': 'application/json',
@@ -300,7 +424,7 @@ document.getElementById('edit-calculation-form').addEventListener('submit', asyn
         if (response.ok) {
             showMessage('calc-message', `Calculation updated! Result: ${data.result}`);
             closeEditModal();
-            loadCalculations();
+            upsertCalculation(data);
         } else {
             alert(data.detail || 'Failed to update calculation');
         }
@@ -316,7 +440,7 @@ async function deleteCalculation(id) {
     }
     
     try {
-        const response = await fetch(`${API_URL}/calculations/${id}`, {
+        const response = await apiFetch(`${API_URL}/calculations/${id}`, {
             method: 'DELETE',
             headers: {
                 'Authorization': `Bearer ${token}`
@@ -325,7 +449,7 @@ async function deleteCalculation(id) {
         
         if (response.ok) {
             showMessage('calc-message', 'Calculation deleted successfully');
-            loadCalculations();
+            removeCalculation(Number(id));
         } else {
             const data = await response.json();
             showMessage('calc-message', data.detail || 'Failed to delete calculation', true);
@@ -5,13 +5,12 @@ Tests authentication and all CRUD endpoints
 import pytest
 from fastapi.testclient import TestClient
 from app.main import app
-from app.database import Base, engine, get_db
-from sqlalchemy import create_engine
+from app.database import Base, engine, get_db, make_engine
 from sqlalchemy.orm import sessionmaker
 
 # Test database
 TEST_DATABASE_URL = "sqlite:///./test.db"
-test_engine = create_engine(TEST_DATABASE_URL, connect_args={"check_same_thread": False})
+test_engine = make_engine(TEST_DATABASE_URL)
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=test_engine)
 
 def override_get_db():
@@ -312,3 +311,982 @@ def test_user_isolation():
         headers={"Authorization": f"Bearer {token2}"}
     )
     assert len(list_response.json()) == 0
+
+def get_auth_headers(username="testuser", email="test@example.com", password="TestPass123"):
+    """Register a user and return bearer auth headers for it"""
+    client.post("/auth/register", json={
+        "username": username,
+        "email": email,
+        "password": password
+    })
+    token = client.post("/auth/token", data={
+        "username": username,
+        "password": password
+    }).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+def test_archived_calculation_read_through(tmp_path, monkeypatch):
+    """Test archived calculations are still readable and exported"""
+    from datetime import datetime, timedelta
+    from app import archive
+    from app.database import Calculation
+
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path))
+    headers = get_auth_headers()
+    old_id = client.post("/calculations/", json={"operand1": 10, "operand2": 5, "operation": "add"}, headers=headers).json()["id"]
+    new_id = client.post("/calculations/", json={"operand1": 2, "operand2": 3, "operation": "multiply"}, headers=headers).json()["id"]
+
+    db = TestingSessionLocal()
+    try:
+        db.query(Calculation).filter(Calculation.id == old_id).update(
+            {"created_at": datetime.utcnow() - timedelta(days=400)}
+        )
+        db.commit()
+        assert archive.archive_calculations(db, older_than_days=365) == 1
+        assert db.query(Calculation).filter(Calculation.id == old_id).first() is None
+    finally:
+        db.close()
+
+    # Hot table only holds the recent calculation
+    assert [c["id"] for c in client.get("/calculations/", headers=headers).json()] == [new_id]
+
+    # Reads fall back to the archive
+    response = client.get(f"/calculations/{old_id}", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["result"] == 15
+
+    # Export includes both hot and archived rows
+    export = client.get("/calculations/export", headers=headers)
+    assert export.status_code == 200
+    assert len([line for line in export.text.splitlines() if line]) == 2
+
+    # Other users cannot read the archived calculation
+    other = get_auth_headers("user2", "user2@example.com")
+    assert client.get(f"/calculations/{old_id}", headers=other).status_code == 404
+
+    # Ids of archived rows are not handed out again, even the highest one
+    db = TestingSessionLocal()
+    try:
+        db.query(Calculation).filter(Calculation.id == new_id).update(
+            {"created_at": datetime.utcnow() - timedelta(days=400)}
+        )
+        db.commit()
+        assert archive.archive_calculations(db, older_than_days=365) == 1
+    finally:
+        db.close()
+    next_id = client.post("/calculations/", json={"operand1": 1, "operand2": 1, "operation": "add"},
+                          headers=headers).json()["id"]
+    assert next_id > new_id
+
+def test_group_commit_create(monkeypatch):
+    """Test calculations created through the group-commit writer"""
+    from concurrent.futures import ThreadPoolExecutor
+    from app import group_commit
+
+    monkeypatch.setattr(group_commit, "GROUP_COMMIT_ENABLED", True)
+    headers = get_auth_headers()
+
+    def create(n):
+        return client.post("/calculations/", json={"operand1": n, "operand2": 1, "operation": "add"}, headers=headers)
+
+    try:
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            responses = list(pool.map(create, range(20)))
+    finally:
+        group_commit.stop_group_commit_writers()
+
+    assert all(r.status_code == 201 for r in responses)
+    assert sorted(r.json()["result"] for r in responses) == [n + 1 for n in range(20)]
+    assert len({r.json()["id"] for r in responses}) == 20
+    # Rows are committed before the response is returned
+    assert len(client.get("/calculations/", headers=headers).json()) == 20
+
+def test_group_commit_isolates_failures():
+    """Test a failing row does not fail the rest of its batch"""
+    from app.group_commit import GroupCommitWriter
+
+    headers = get_auth_headers()
+    user_id = client.get("/auth/me", headers=headers).json()["id"]
+    writer = GroupCommitWriter(test_engine, max_delay_ms=50)
+    try:
+        good = writer.submit({"operation": "add", "operand1": 1, "operand2": 2, "result": 3, "user_id": user_id})
+        bad = writer.submit({"operation": "add", "operand1": 1, "operand2": 2, "result": None, "user_id": user_id})
+        assert good.result(5)["result"] == 3
+        with pytest.raises(Exception):
+            bad.result(5)
+    finally:
+        writer.stop()
+
+def test_group_commit_deadline_withdraws_row(monkeypatch):
+    """Test a create whose deadline passes in the queue answers 503 and is never committed"""
+    import threading
+    from app import group_commit
+
+    headers = get_auth_headers()
+    monkeypatch.setattr(group_commit, "GROUP_COMMIT_ENABLED", True)
+    writer = group_commit.get_group_commit_writer(test_engine)
+    # Hold the writer so the row is still queued when the request deadline passes
+    release = threading.Event()
+    flush = writer._flush
+    monkeypatch.setattr(writer, "_flush", lambda batch: (release.wait(5), flush(batch)))
+    try:
+        response = client.post("/calculations/", json={"operand1": 1, "operand2": 2, "operation": "add"},
+                               headers={**headers, "X-Request-Timeout": "300"})
+        assert response.status_code == 503
+        assert response.json()["detail"] == "Request deadline exceeded"
+    finally:
+        release.set()
+        group_commit.stop_group_commit_writers()
+    assert client.get("/calculations/", headers=headers).json() == []
+
+def wait_for_job(job_id, headers, timeout=10):
+    """Poll a calculation job until it finishes"""
+    import time
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = client.get(f"/calculations/jobs/{job_id}", headers=headers).json()
+        if job["status"] in ("completed", "failed"):
+            return job
+        time.sleep(0.05)
+    raise AssertionError("job did not finish in time")
+
+def test_calculation_job(tmp_path, monkeypatch):
+    """Test background processing of a calculation batch"""
+    from app import jobs
+
+    monkeypatch.setattr(jobs, "JOB_RESULTS_DIR", str(tmp_path))
+    headers = get_auth_headers()
+    items = [{"operand1": n, "operand2": 2, "operation": "multiply"} for n in range(5)]
+    items.append({"operand1": 1, "operand2": 0, "operation": "divide"})
+
+    response = client.post("/calculations/jobs", json={"calculations": items}, headers=headers)
+    assert response.status_code == 202
+    try:
+        job = wait_for_job(response.json()["id"], headers)
+    finally:
+        jobs.stop_job_runners()
+
+    assert job["status"] == "completed"
+    assert job["total"] == 6
+    assert job["processed"] == 6
+    assert job["failed"] == 1
+    results = client.get(job["results_url"], headers=headers)
+    lines = [line for line in results.text.splitlines() if line]
+    assert len(lines) == 6
+    assert "error" in lines[-1]
+    assert len(client.get("/calculations/", headers=headers).json()) == 5
+
+    # Jobs are private to their owner
+    other = get_auth_headers("user2", "user2@example.com")
+    assert client.get(f"/calculations/jobs/{job['id']}", headers=other).status_code == 404
+
+def test_calculation_job_upload(tmp_path, monkeypatch):
+    """Test submitting a calculation job as a CSV upload"""
+    import os
+    from app import jobs
+
+    monkeypatch.setattr(jobs, "JOB_RESULTS_DIR", str(tmp_path))
+    headers = get_auth_headers()
+    csv_content = "operation,operand1,operand2\nadd,1,2\nsubtract,10,4\n"
+    response = client.post("/calculations/jobs/upload",
+        files={"file": ("calculations.csv", csv_content, "text/csv")},
+        headers=headers
+    )
+    assert response.status_code == 202
+    try:
+        job = wait_for_job(response.json()["id"], headers)
+    finally:
+        jobs.stop_job_runners()
+    assert job["status"] == "completed"
+    assert sorted(c["result"] for c in client.get("/calculations/", headers=headers).json()) == [3, 6]
+
+    # Undecodable or malformed files are rejected, not a server error
+    for name, content in (("calculations.csv", b"operation,operand1\n\xff\xfe,1\n"),
+                          ("calculations.ndjson", b"\xff\xfe"),
+                          ("calculations.csv", b'operation,operand1\n"' + b"a" * 200000 + b'",1\n')):
+        response = client.post("/calculations/jobs/upload", files={"file": (name, content)}, headers=headers)
+        assert response.status_code == 400
+
+    # A results file that has gone missing is reported, not a 500
+    os.remove(os.path.join(str(tmp_path), os.listdir(str(tmp_path))[0]))
+    assert client.get(job["results_url"], headers=headers).status_code == 409
+
+def test_calculation_job_resumes_after_restart(tmp_path, monkeypatch):
+    """Test interrupted jobs are picked up again from their checkpoint"""
+    import json
+    from datetime import datetime, timedelta
+    from app import jobs
+    from app.database import CalculationJob
+
+    monkeypatch.setattr(jobs, "JOB_RESULTS_DIR", str(tmp_path))
+    headers = get_auth_headers()
+    user_id = client.get("/auth/me", headers=headers).json()["id"]
+    items = [{"operand1": n, "operand2": 1, "operation": "add"} for n in range(4)]
+
+    db = TestingSessionLocal()
+    try:
+        # Simulate a job left "running" by a worker that died mid-way
+        job = CalculationJob(user_id=user_id, payload=json.dumps(items), total=4, status="running",
+                             owner="dead-worker", lease_until=datetime.utcnow() - timedelta(seconds=1))
+        # ...and one another process is still working on under a live lease
+        busy = CalculationJob(user_id=user_id, payload=json.dumps(items), total=4, status="running",
+                              owner="live-worker", lease_until=datetime.utcnow() + timedelta(minutes=5))
+        db.add_all([job, busy])
+        db.commit()
+        job_id, busy_id = job.id, busy.id
+    finally:
+        db.close()
+
+    runner = jobs.JobRunner(test_engine, chunk_size=2)
+    try:
+        assert runner.resume_pending() == 1
+        job = wait_for_job(job_id, headers)
+        runner.enqueue(busy_id).result()
+    finally:
+        runner.stop()
+    assert job["status"] == "completed"
+    assert job["processed"] == 4
+    busy = client.get(f"/calculations/jobs/{busy_id}", headers=headers).json()
+    assert busy["status"] == "running" and busy["processed"] == 0
+
+def test_calculation_websocket():
+    """Test streaming calculations over the WebSocket endpoint"""
+    headers = get_auth_headers()
+    token = headers["Authorization"].split(" ", 1)[1]
+
+    with client.websocket_connect(f"/calculations/ws?token={token}") as websocket:
+        # Pipeline several messages before reading any reply
+        websocket.send_json({"ref": 1, "operand1": 10, "operand2": 5, "operation": "add"})
+        websocket.send_json([
+            {"ref": 2, "operand1": 3, "operand2": 4, "operation": "multiply"},
+            {"ref": 3, "operand1": 1, "operand2": 0, "operation": "divide"}
+        ])
+        websocket.send_text("not json")
+        # null is a bad message, not the end of the stream
+        websocket.send_text("[null, {\"ref\": 4, \"operand1\": 2, \"operand2\": 2, \"operation\": \"add\"}]")
+        replies = [websocket.receive_json() for _ in range(6)]
+
+    assert replies[0]["ref"] == 1 and replies[0]["result"] == 15
+    assert replies[1]["ref"] == 2 and replies[1]["result"] == 12
+    assert replies[2]["ref"] == 3 and replies[2]["error"] == "Cannot divide by zero"
+    assert replies[3]["error"] == "Invalid JSON"
+    assert replies[4]["error"] == "Expected a calculation object"
+    assert replies[5]["ref"] == 4 and replies[5]["result"] == 4
+    assert len(client.get("/calculations/", headers=headers).json()) == 3
+
+def test_calculation_websocket_rejects_invalid_token():
+    """Test the WebSocket endpoint refuses unauthenticated connections"""
+    from starlette.websockets import WebSocketDisconnect
+
+    with pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect("/calculations/ws?token=invalid") as websocket:
+            websocket.receive_json()
+
+async def test_calculation_events_published():
+    """Test create/update/delete are published to the owner's subscribers"""
+    import asyncio
+    from app.events import get_event_broker
+
+    headers = get_auth_headers()
+    user_id = client.get("/auth/me", headers=headers).json()["id"]
+    broker = get_event_broker()
+    subscription = broker.subscribe(user_id)
+    try:
+        calc_id = client.post("/calculations/", json={"operand1": 10, "operand2": 5, "operation": "add"}, headers=headers).json()["id"]
+        client.patch(f"/calculations/{calc_id}", json={"operand2": 8}, headers=headers)
+        client.delete(f"/calculations/{calc_id}", headers=headers)
+        client.post("/calculations/", json={"operand1": 1, "operand2": 0, "operation": "divide"}, headers=headers)
+
+        events = [await asyncio.wait_for(subscription.get(), 2) for _ in range(3)]
+    finally:
+        broker.unsubscribe(subscription)
+
+    assert [e["type"] for e in events] == ["created", "updated", "deleted"]
+    assert events[0]["data"]["result"] == 15
+    assert events[1]["data"]["result"] == 18
+    assert events[2]["data"] == {"id": calc_id}
+    assert subscription.queue.empty()
+
+async def test_event_subscription_overflow():
+    """Test a slow subscriber is asked to resync instead of growing unbounded"""
+    import asyncio
+    from app.events import InProcessBroker
+
+    broker = InProcessBroker(maxsize=2)
+    subscription = broker.subscribe(1)
+    for n in range(3):
+        broker.publish(1, {"type": "created", "data": {"id": n}})
+    broker.publish(2, {"type": "created", "data": {"id": 99}})
+    await asyncio.sleep(0)
+
+    assert (await subscription.get())["type"] == "resync"
+    assert subscription.queue.empty()
+
+def test_calculation_events_require_auth():
+    """Test the change feed rejects invalid tokens"""
+    response = client.get("/calculations/events?token=invalid")
+    assert response.status_code == 401
+
+def test_calculation_changes_since_checkpoint():
+    """Test delta sync returns only changes and deletions after a token"""
+    headers = get_auth_headers()
+    first = client.post("/calculations/", json={"operand1": 1, "operand2": 1, "operation": "add"}, headers=headers).json()["id"]
+    second = client.post("/calculations/", json={"operand1": 2, "operand2": 2, "operation": "add"}, headers=headers).json()["id"]
+
+    full = client.get("/calculations/changes", headers=headers).json()
+    assert [c["id"] for c in full["changes"]] == [first, second]
+    assert full["deleted"] == []
+    token = full["next_token"]
+
+    # Nothing changed since the checkpoint
+    assert client.get(f"/calculations/changes?since={token}", headers=headers).json()["changes"] == []
+
+    client.patch(f"/calculations/{first}", json={"operand2": 5}, headers=headers)
+    client.delete(f"/calculations/{second}", headers=headers)
+    third = client.post("/calculations/", json={"operand1": 3, "operand2": 3, "operation": "multiply"}, headers=headers).json()["id"]
+
+    delta = client.get(f"/calculations/changes?since={token}", headers=headers).json()
+    assert [c["id"] for c in delta["changes"]] == [first, third]
+    assert delta["changes"][0]["result"] == 6
+    assert delta["deleted"] == [second]
+    assert delta["has_more"] is False
+
+    # Paging through the same delta one entry at a time
+    page = client.get(f"/calculations/changes?since={token}&limit=1", headers=headers).json()
+    assert page["has_more"] is True
+    assert [c["id"] for c in page["changes"]] == [first]
+
+    # Another user's changes are not visible
+    other = get_auth_headers("user2", "user2@example.com")
+    assert client.get("/calculations/changes", headers=other).json()["changes"] == []
+    assert client.get("/calculations/changes?since=abc", headers=headers).status_code == 400
+
+def test_migrate_to_compact_schema(tmp_path):
+    """Test legacy databases are migrated to the compact calculations layout"""
+    from sqlalchemy import inspect, text
+    from app.migrations import migrate
+    from app.database import Calculation
+
+    legacy_engine = make_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with legacy_engine.begin() as conn:
+        conn.execute(text("CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR NOT NULL, "
+                          "email VARCHAR NOT NULL, hashed_password VARCHAR NOT NULL, created_at DATETIME)"))
+        conn.execute(text("CREATE TABLE calculations (id INTEGER PRIMARY KEY, operation VARCHAR NOT NULL, "
+                          "operand1 FLOAT NOT NULL, operand2 FLOAT NOT NULL, result FLOAT NOT NULL, "
+                          "user_id INTEGER NOT NULL REFERENCES users(id), created_at DATETIME, updated_at DATETIME)"))
+        conn.execute(text("CREATE INDEX ix_calculations_id ON calculations (id)"))
+        conn.execute(text("INSERT INTO users VALUES (1, 'u', 'u@example.com', 'x', '2024-01-01 00:00:00')"))
+        conn.execute(text("INSERT INTO calculations VALUES (7, 'divide', 9, 3, 3, 1, '2024-01-01 00:00:00', NULL), "
+                          "(8, 'multiply', 2, 5, 10, 1, NULL, NULL)"))
+
+    assert migrate(legacy_engine) == ["users.change_seq", "compact calculations layout", "users.calculation_count"]
+    assert migrate(legacy_engine) == []
+
+    with legacy_engine.connect() as conn:
+        assert conn.execute(text("SELECT operation FROM calculations ORDER BY id")).scalars().all() == [4, 3]
+        assert conn.execute(text("SELECT calculation_count FROM users")).scalar() == 2
+        assert "AUTOINCREMENT" in conn.execute(
+            text("SELECT sql FROM sqlite_master WHERE name = 'calculations'")
+        ).scalar().upper()
+    assert "ix_calculations_id" not in {i["name"] for i in inspect(legacy_engine).get_indexes("calculations")}
+
+    session = sessionmaker(bind=legacy_engine)()
+    try:
+        rows = session.query(Calculation).order_by(Calculation.id).all()
+        assert [(r.id, r.operation) for r in rows] == [(7, "divide"), (8, "multiply")]
+        assert all(r.created_at is not None and r.updated_at is not None for r in rows)
+        session.add(Calculation(operation="add", operand1=1, operand2=1, result=2, user_id=1))
+        session.commit()
+    finally:
+        session.close()
+
+def test_browse_calculations_msgpack():
+    """Test the list endpoint returns MessagePack when requested"""
+    msgpack = pytest.importorskip("msgpack")
+    headers = get_auth_headers()
+    client.post("/calculations/", json={"operand1": 10, "operand2": 5, "operation": "add"}, headers=headers)
+
+    response = client.get("/calculations/", headers={**headers, "Accept": "application/msgpack"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/msgpack"
+    rows = msgpack.unpackb(response.content)
+    assert rows[0]["result"] == 15
+    assert rows[0]["operation"] == "add"
+
+def test_browse_and_export_calculations_arrow():
+    """Test the list and export endpoints return Arrow IPC streams"""
+    pa = pytest.importorskip("pyarrow")
+    headers = get_auth_headers()
+    for n in range(3):
+        client.post("/calculations/", json={"operand1": n, "operand2": 2, "operation": "multiply"}, headers=headers)
+    arrow_headers = {**headers, "Accept": "application/vnd.apache.arrow.stream"}
+
+    table = pa.ipc.open_stream(client.get("/calculations/", headers=arrow_headers).content).read_all()
+    assert table.column("result").to_pylist() == [0, 2, 4]
+
+    export = pa.ipc.open_stream(client.get("/calculations/export", headers=arrow_headers).content).read_all()
+    assert export.num_rows == 3
+    assert export.column("operation").to_pylist() == ["multiply"] * 3
+
+def test_unsupported_accept_is_rejected():
+    """Test a request for an unknown format gets 406 and negotiated responses vary on Accept"""
+    headers = get_auth_headers()
+    response = client.get("/calculations/", headers={**headers, "Accept": "text/csv"})
+    assert response.status_code == 406
+    assert response.headers["vary"] == "Accept"
+    # NDJSON is only produced by the export
+    response = client.get("/calculations/", headers={**headers, "Accept": "application/x-ndjson"})
+    assert response.status_code == 406
+
+    # Shared caches must key every negotiated representation on Accept
+    for path in ("/calculations/", "/calculations/export"):
+        response = client.get(path, headers=headers)
+        assert response.status_code == 200
+        assert "Accept" in response.headers["vary"]
+
+def test_large_responses_are_compressed():
+    """Test responses above the threshold are gzip compressed and small ones are not"""
+    headers = get_auth_headers()
+    for n in range(20):
+        client.post("/calculations/", json={"operand1": n, "operand2": 1, "operation": "add"}, headers=headers)
+
+    response = client.get("/calculations/", headers={**headers, "Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert len(response.json()) == 20
+
+    small = client.get("/health", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in small.headers
+
+    export = client.get("/calculations/export", headers={**headers, "Accept-Encoding": "gzip"})
+    assert export.headers["content-encoding"] == "gzip"
+    assert len(export.text.splitlines()) == 20
+
+def test_static_assets_are_hashed_and_cached():
+    """Test index.html references content-hashed assets served with immutable caching"""
+    import re
+
+    index = client.get("/")
+    assert index.status_code == 200
+    assert index.headers["cache-control"] == "no-cache"
+    script = re.search(r'src="(/static/app\.[0-9a-f]{12}\.js)"', index.text).group(1)
+    assert re.search(r'href="/static/styles\.[0-9a-f]{12}\.css"', index.text)
+
+    asset = client.get(script, headers={"Accept-Encoding": "gzip"})
+    assert asset.status_code == 200
+    assert asset.headers["cache-control"] == "public, max-age=31536000, immutable"
+    assert asset.headers["content-encoding"] == "gzip"
+    assert "loadCalculations" in asset.text
+
+    revalidated = client.get(script, headers={"If-None-Match": asset.headers["etag"]})
+    assert revalidated.status_code == 304
+
+    # Unhashed names keep working for old pages
+    assert client.get("/static/app.js").status_code == 200
+    assert client.get("/static/missing.js").status_code == 404
+
+def test_stale_precompressed_assets_are_ignored(tmp_path):
+    """Test a .gz older than its source is replaced by compressing the source"""
+    import gzip
+    import os
+    from app.static_assets import StaticAssetCache
+
+    source = tmp_path / "app.js"
+    source.write_text("console.log('new');" * 100)
+    stale = tmp_path / "app.js.gz"
+    stale.write_bytes(gzip.compress(b"console.log('old');" * 100))
+    os.utime(stale, (source.stat().st_mtime - 60, source.stat().st_mtime - 60))
+
+    cache = StaticAssetCache(str(tmp_path))
+    cache.load()
+    assert gzip.decompress(cache.assets["app.js"].variants["gzip"]) == source.read_bytes()
+
+    os.utime(stale, (source.stat().st_mtime + 60, source.stat().st_mtime + 60))
+    cache.load()
+    assert cache.assets["app.js"].variants["gzip"] == stale.read_bytes()
+
+def test_refresh_token_rotation():
+    """Test refresh tokens issue new access tokens and rotate on use"""
+    client.post("/auth/register", json={
+        "username": "testuser",
+        "email": "test@example.com",
+        "password": "TestPass123"
+    })
+    tokens = client.post("/auth/token", data={
+        "username": "testuser",
+        "password": "TestPass123"
+    }).json()
+    assert tokens["refresh_token"]
+
+    refreshed = client.post("/auth/refresh", json={"refresh_token": tokens["refresh_token"]})
+    assert refreshed.status_code == 200
+    new_tokens = refreshed.json()
+    assert new_tokens["refresh_token"] != tokens["refresh_token"]
+    me = client.get("/auth/me", headers={"Authorization": f"Bearer {new_tokens['access_token']}"})
+    assert me.json()["username"] == "testuser"
+
+    # Reusing a rotated token is rejected and revokes the whole chain
+    assert client.post("/auth/refresh", json={"refresh_token": tokens["refresh_token"]}).status_code == 401
+    assert client.post("/auth/refresh", json={"refresh_token": new_tokens["refresh_token"]}).status_code == 401
+
+def test_logout_revokes_refresh_token():
+    """Test logout revokes the refresh token and bad tokens are rejected"""
+    client.post("/auth/register", json={
+        "username": "testuser",
+        "email": "test@example.com",
+        "password": "TestPass123"
+    })
+    refresh_token = client.post("/auth/token", data={
+        "username": "testuser",
+        "password": "TestPass123"
+    }).json()["refresh_token"]
+
+    assert client.post("/auth/logout", json={"refresh_token": refresh_token}).status_code == 204
+    assert client.post("/auth/refresh", json={"refresh_token": refresh_token}).status_code == 401
+    token_id = refresh_token.split(".")[0]
+    assert client.post("/auth/refresh", json={"refresh_token": f"{token_id}.forged"}).status_code == 401
+    assert client.post("/auth/refresh", json={"refresh_token": "garbage"}).status_code == 401
+
+def test_bulk_provision_users(tmp_path):
+    """Test bulk provisioning creates users and reports conflicts per line"""
+    from app.provision import provision_users, read_users
+
+    client.post("/auth/register", json={
+        "username": "existing",
+        "email": "existing@example.com",
+        "password": "TestPass123"
+    })
+    users_file = tmp_path / "users.csv"
+    users_file.write_text(
+        "username,email,password\n"
+        "alice,alice@example.com,AlicePass123\n"
+        "bob,bob@example.com,BobPass1234\n"
+        "existing,other@example.com,TestPass123\n"
+        "alice,alice2@example.com,AlicePass123\n"
+        "carol,not-an-email,CarolPass123\n"
+    )
+
+    db = TestingSessionLocal()
+    try:
+        report = provision_users(db, read_users(str(users_file)), workers=2, batch_size=1)
+    finally:
+        db.close()
+
+    assert report.created == 2
+    assert [line for line, _ in report.conflicts] == [4, 5, 6]
+    assert "already registered" in report.conflicts[0][1]
+    assert "duplicate username" in report.conflicts[1][1]
+    assert "email" in report.conflicts[2][1]
+
+    # Provisioned users can log in
+    response = client.post("/auth/token", data={"username": "bob", "password": "BobPass1234"})
+    assert response.status_code == 200
+
+    # A malformed NDJSON line is reported and the rest is still provisioned
+    ndjson_file = tmp_path / "users.ndjson"
+    ndjson_file.write_text(
+        '{"username": "dave", "email": "dave@example.com", "password": "DavePass123"}\n'
+        '{"username": "eve", "email":\n'
+        '{"username": "frank", "email": "frank@example.com", "password": "FrankPass123"}\n'
+    )
+    db = TestingSessionLocal()
+    try:
+        report = provision_users(db, read_users(str(ndjson_file)), workers=1)
+    finally:
+        db.close()
+    assert report.created == 2
+    assert [line for line, _ in report.conflicts] == [2]
+    assert report.conflicts[0][1].startswith("invalid JSON")
+
+def test_profiling_middleware_writes_profile(tmp_path):
+    """Test requests are profiled only when the privileged header is sent"""
+    from app.profiling import ProfilingMiddleware
+
+    profiled_client = TestClient(ProfilingMiddleware(app, token="secret", directory=str(tmp_path)))
+    headers = get_auth_headers()
+
+    response = profiled_client.get("/calculations/", headers=headers)
+    assert response.status_code == 200
+    assert "x-profile-id" not in response.headers
+    assert list(tmp_path.iterdir()) == []
+
+    response = profiled_client.get("/calculations/", headers={**headers, "X-Profile": "secret"})
+    assert response.status_code == 200
+    profile_id = response.headers["x-profile-id"]
+    summary = (tmp_path / f"{profile_id}.txt").read_text()
+    assert summary.startswith("GET /calculations/ -> 200")
+    assert "Top functions by self samples:" in summary
+    assert (tmp_path / f"{profile_id}.collapsed").exists()
+
+def test_tracing_records_request_phases():
+    """Test request phases are recorded as spans of the propagated trace"""
+    from app import tracing
+
+    exporter = tracing.InMemorySpanExporter()
+    previous = tracing.get_span_exporter()
+    tracing.set_span_exporter(exporter)
+    tracing.install()
+    try:
+        traced_client = TestClient(tracing.TracingMiddleware(app))
+        headers = get_auth_headers()
+        trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+        response = traced_client.post(
+            "/calculations/",
+            json={"operation": "multiply", "operand1": 6, "operand2": 7},
+            headers={**headers, "traceparent": f"00-{trace_id}-00f067aa0ba902b7-01"}
+        )
+        assert response.status_code == 201
+        assert response.headers["traceparent"].startswith(f"00-{trace_id}-")
+    finally:
+        tracing.set_span_exporter(previous)
+
+    spans = [span for span in exporter.get_finished_spans() if span.trace.trace_id == trace_id]
+    names = [span.name for span in spans]
+    root = next(span for span in spans if span.name == "POST /calculations/")
+    assert root.parent_span_id == "00f067aa0ba902b7"
+    assert root.attributes["http.status_code"] == 201
+    for name in ("auth.get_current_user", "db.query", "calculate_result", "serialize_response"):
+        assert name in names
+    assert all(span.parent_span_id for span in spans)
+    assert any("INSERT INTO calculations" in span.attributes.get("db.statement", "") for span in spans)
+    otlp = root.to_otlp()
+    assert otlp["traceId"] == trace_id and otlp["kind"] == tracing.SPAN_KIND_SERVER
+
+def test_sqlite_profile_serializes_concurrent_writers():
+    """Test the SQLite engine runs in WAL mode and concurrent writers do not fail"""
+    import threading
+    from sqlalchemy import text
+    from app.database import User
+
+    with test_engine.connect() as connection:
+        assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+
+    errors = []
+
+    def write(worker):
+        db = TestingSessionLocal()
+        try:
+            for index in range(20):
+                db.add(User(username=f"writer{worker}_{index}", email=f"w{worker}_{index}@example.com",
+                            hashed_password="x"))
+                db.commit()
+                db.query(User).filter(User.username == f"writer{worker}_{index}").one()
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            db.close()
+
+    threads = [threading.Thread(target=write, args=(worker,)) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    db = TestingSessionLocal()
+    try:
+        assert db.query(User).count() == 160
+    finally:
+        db.close()
+
+def test_retention_purge_in_batches(tmp_path, monkeypatch):
+    """Test expired calculations are purged per policy with tombstones and checkpoints"""
+    from datetime import datetime, timedelta
+    from app import archive
+    from app.database import Calculation, RetentionRun, User
+    from app.retention import purge_expired, set_policy
+
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path))
+    headers = get_auth_headers()
+    other = get_auth_headers("user2", "user2@example.com")
+    ids = [client.post("/calculations/", json={"operand1": i, "operand2": 1, "operation": "add"}, headers=headers).json()["id"]
+           for i in range(5)]
+    other_id = client.post("/calculations/", json={"operand1": 1, "operand2": 1, "operation": "add"}, headers=other).json()["id"]
+    token = client.get("/calculations/changes", headers=headers).json()["next_token"]
+
+    db = TestingSessionLocal()
+    try:
+        # Four old rows, one of them already archived; user2 has no policy
+        db.query(Calculation).filter(Calculation.id.in_(ids[:4] + [other_id])).update(
+            {"created_at": datetime.utcnow() - timedelta(days=100)}, synchronize_session=False
+        )
+        db.commit()
+        db.query(Calculation).filter(Calculation.id == ids[0]).update(
+            {"created_at": datetime.utcnow() - timedelta(days=400)}
+        )
+        db.commit()
+        assert archive.archive_calculations(db, older_than_days=365) == 1
+
+        user_id = db.query(Calculation.user_id).filter(Calculation.id == ids[1]).scalar()
+        set_policy(db, 30, user_id)
+        assert purge_expired(db, batch_size=2, pause_ms=0) == 4
+        run = db.query(RetentionRun).one()
+        assert run.status == "completed" and run.deleted == 4
+        assert purge_expired(db, batch_size=2, pause_ms=0) == 0
+        assert db.get(User, user_id).calculation_count == 1
+    finally:
+        db.close()
+
+    assert [c["id"] for c in client.get("/calculations/", headers=headers).json()] == [ids[4]]
+    assert client.get(f"/calculations/{ids[0]}", headers=headers).status_code == 404
+    assert client.get(f"/calculations/{other_id}", headers=other).status_code == 200
+    changes = client.get(f"/calculations/changes?since={token}", headers=headers).json()
+    assert sorted(changes["deleted"]) == ids[:4]
+
+def test_sharded_users_and_resharding(tmp_path, monkeypatch):
+    """Test users are spread over shards, unique globally, and movable online"""
+    from sqlalchemy import text
+    from app.sharding import ShardRouter, move_user, set_shard_router
+
+    router = ShardRouter(
+        {name: f"sqlite:///{tmp_path / name}.db" for name in ("shard0", "shard1")},
+        f"sqlite:///{tmp_path / 'directory.db'}"
+    )
+    router.create_all()
+
+    def sharded_get_db():
+        db = router.session()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    set_shard_router(router)
+    monkeypatch.setitem(app.dependency_overrides, get_db, sharded_get_db)
+    try:
+        users = [f"user{index}" for index in range(6)]
+        headers = {username: get_auth_headers(username, f"{username}@example.com") for username in users}
+        placement = {username: router.lookup(username).shard for username in users}
+        assert set(placement.values()) == {"shard0", "shard1"}
+        assert all(placement[name] == router.ring.node_for(router.lookup(name).user_id) for name in users)
+
+        # Uniqueness is global even though the users live on different shards
+        duplicate = client.post("/auth/register", json={
+            "username": "someone", "email": "user0@example.com", "password": "TestPass123"
+        })
+        assert duplicate.status_code == 400
+        assert duplicate.json()["detail"] == "Email already registered"
+
+        # Bulk provisioning registers users in the directory and on their shard
+        from app.provision import provision_users
+        report = provision_users(router.session(), [
+            (1, {"username": "bulk0", "email": "bulk0@example.com", "password": "BulkPass123"}),
+            (2, {"username": "bulk1", "email": "bulk1@example.com", "password": "BulkPass123"}),
+            (3, {"username": "bulk2", "email": "user1@example.com", "password": "BulkPass123"}),
+        ], workers=1)
+        assert report.created == 2 and [line for line, _ in report.conflicts] == [3]
+        assert router.lookup("bulk0").user_id not in {router.lookup(name).user_id for name in users}
+        response = client.post("/auth/token", data={"username": "bulk1", "password": "BulkPass123"})
+        assert response.status_code == 200
+
+        ids = []
+        for username in users:
+            response = client.post("/calculations/", json={"operand1": 6, "operand2": 7, "operation": "multiply"},
+                                   headers=headers[username])
+            assert response.status_code == 201
+            ids.append(response.json()["id"])
+        assert len(set(ids)) == len(ids)
+
+        # Move one user with a calculation, an update and a delete to the other shard
+        mover = users[0]
+        source = placement[mover]
+        target = "shard1" if source == "shard0" else "shard0"
+        extra = client.post("/calculations/", json={"operand1": 1, "operand2": 2, "operation": "add"},
+                            headers=headers[mover]).json()["id"]
+        token = client.get("/calculations/changes", headers=headers[mover]).json()["next_token"]
+        client.patch(f"/calculations/{ids[0]}", json={"operand1": 10}, headers=headers[mover])
+        client.delete(f"/calculations/{extra}", headers=headers[mover])
+
+        user_id = router.lookup(mover).user_id
+        assert move_user(router, user_id, target, batch_size=1) > 0
+        assert router.lookup(mover).shard == target
+        with router.engines[source].connect() as connection:
+            assert connection.execute(text(f"SELECT COUNT(*) FROM calculations WHERE user_id = {user_id}")).scalar() == 0
+
+        listed = client.get("/calculations/", headers=headers[mover]).json()
+        assert [(c["id"], c["result"]) for c in listed] == [(ids[0], 70)]
+        changes = client.get(f"/calculations/changes?since={token}", headers=headers[mover]).json()
+        assert [c["id"] for c in changes["changes"]] == [ids[0]] and changes["deleted"] == [extra]
+        created = client.post("/calculations/", json={"operand1": 1, "operand2": 1, "operation": "add"},
+                              headers=headers[mover])
+        assert created.status_code == 201 and created.json()["id"] not in ids + [extra]
+
+        # The maintenance CLIs cover every shard
+        import sys
+        from app import archive, retention
+        monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path / "archive"))
+        monkeypatch.setattr(sys, "argv", ["app.archive", "--days", "0"])
+        archive.main()
+        for shard_engine in router.engines.values():
+            with shard_engine.connect() as connection:
+                assert connection.execute(text("SELECT COUNT(*) FROM calculations")).scalar() == 0
+        monkeypatch.setattr(sys, "argv", ["app.retention", "policy", "--days", "0"])
+        retention.main()
+        monkeypatch.setattr(sys, "argv", ["app.retention", "run", "--pause-ms", "0"])
+        retention.main()
+        assert archive.max_archived_id() == 0
+    finally:
+        set_shard_router(None)
+        router.dispose()
+
+def test_expression_calculations():
+    """Test the expression operation, its validation and vectorized evaluation"""
+    from app.expressions import compile_expression
+
+    headers = get_auth_headers()
+    response = client.post("/calculations/", json={
+        "operation": "expression", "expression": "sqrt(x**2 + y**2) / n", "variables": {"x": 3, "y": 4, "n": 2}
+    }, headers=headers)
+    assert response.status_code == 201
+    data = response.json()
+    assert data["result"] == 2.5 and data["operand1"] is None and data["variables"] == {"x": 3, "y": 4, "n": 2}
+
+    # Updating the variables recomputes the result
+    response = client.patch(f"/calculations/{data['id']}", json={"variables": {"x": 6, "y": 8, "n": 5}}, headers=headers)
+    assert response.json()["result"] == 2
+
+    # Unsafe or malformed expressions are rejected before evaluation
+    for expression in ("__import__('os')", "x.real", "(lambda: 1)()", "1 +", "1" + "0" * 400):
+        response = client.post("/calculations/", json={"operation": "expression", "expression": expression},
+                               headers=headers)
+        assert response.status_code == 422
+    response = client.post("/calculations/evaluate", json={"expression": "x + 1" + "0" * 400, "bindings": [{"x": 1}]},
+                           headers=headers)
+    assert response.status_code == 422
+    response = client.post("/calculations/", json={"operation": "expression", "expression": "1 / x",
+                                                   "variables": {"x": 0}}, headers=headers)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Cannot divide by zero"
+    response = client.post("/calculations/", json={"operation": "add", "operand1": 1}, headers=headers)
+    assert response.status_code == 422
+
+    response = client.post("/calculations/evaluate", json={
+        "expression": "a * b + 1", "bindings": [{"a": 2, "b": 3}, {"a": 1}, {"a": 0.5, "b": 4}]
+    }, headers=headers)
+    assert response.status_code == 200
+    assert response.json() == {
+        "results": [7, None, 3],
+        "errors": [{"index": 1, "error": "Missing variables: b"}]
+    }
+    # Compiled once, served from the cache afterwards
+    assert compile_expression("a * b + 1") is compile_expression("a * b + 1")
+
+def test_deadlines_and_circuit_breaker(monkeypatch):
+    """Test statements are cut off at the deadline and an open breaker fails fast with 503"""
+    import time
+    from sqlalchemy import text
+    from sqlalchemy.exc import OperationalError
+    from app.resilience import CircuitBreaker, get_breaker, request_deadline
+
+    slow_query = text("WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) "
+                      "SELECT count(*) FROM (SELECT x FROM c LIMIT 100000000)")
+    started = time.monotonic()
+    with request_deadline(0.05):
+        with pytest.raises(OperationalError):
+            with test_engine.connect() as connection:
+                connection.execute(slow_query)
+    assert time.monotonic() - started < 2
+
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=0.05)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()  # the half-open probe
+    assert breaker.state == "half_open" and not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
+
+    from app import main
+    monkeypatch.setattr(main, "engine", test_engine)
+    headers = get_auth_headers()
+    shared = get_breaker(test_engine)
+    try:
+        for _ in range(shared.failure_threshold):
+            shared.record_failure()
+        response = client.get("/calculations/", headers=headers)
+        assert response.status_code == 503
+        assert int(response.headers["Retry-After"]) >= 1
+        response = client.get("/health/ready")
+        assert response.status_code == 503
+        assert response.json()["databases"][0]["breaker"] == "open"
+    finally:
+        shared.record_success()
+
+    response = client.get("/health/ready")
+    assert response.status_code == 200
+    database = response.json()["databases"][0]
+    assert database["breaker"] == "closed" and database["probe"] == "ok"
+    assert "checkedout" in database["pool"]
+
+def test_bulk_update_and_delete_by_filter():
+    """Test set-based PATCH/DELETE /calculations recompute results and report division by zero"""
+    headers = get_auth_headers()
+    payloads = [
+        {"operation": "add", "operand1": 1, "operand2": 2},
+        {"operation": "divide", "operand1": 6, "operand2": 3},
+        {"operation": "expression", "expression": "x + 1", "variables": {"x": 1}},
+        {"operation": "subtract", "operand1": 9, "operand2": 4},
+        {"operation": "multiply", "operand1": 2, "operand2": 2},
+    ]
+    ids = [client.post("/calculations/", json=payload, headers=headers).json()["id"] for payload in payloads]
+    checkpoint = client.get("/calculations/changes", headers=headers).json()["next_token"]
+
+    response = client.patch("/calculations/", json={"operand2": 0}, headers=headers,
+                            params={"ids": ids[:3]})
+    assert response.status_code == 200
+    assert response.json() == {"matched": 3, "updated": 1, "division_by_zero": [ids[1]], "skipped_expressions": 1}
+    assert client.get(f"/calculations/{ids[0]}", headers=headers).json()["result"] == 1
+    assert client.get(f"/calculations/{ids[1]}", headers=headers).json()["result"] == 2
+
+    response = client.patch("/calculations/", json={"operation": "multiply", "operand1": 3}, headers=headers,
+                            params={"operation": "divide"})
+    assert response.json()["updated"] == 1
+    updated = client.get(f"/calculations/{ids[1]}", headers=headers).json()
+    assert updated["operation"] == "multiply" and updated["result"] == 9
+
+    response = client.patch("/calculations/", json={"operation": "expression"}, headers=headers,
+                            params={"ids": ids})
+    assert response.status_code == 400
+    assert client.delete("/calculations/", headers=headers).status_code == 400
+
+    response = client.delete("/calculations/", headers=headers, params={"operation": "subtract"})
+    assert response.json() == {"deleted": 1}
+    assert client.get(f"/calculations/{ids[3]}", headers=headers).status_code == 404
+
+    changes = client.get(f"/calculations/changes?since={checkpoint}", headers=headers).json()
+    assert sorted(change["id"] for change in changes["changes"]) == [ids[0], ids[1]]
+    assert changes["deleted"] == [ids[3]]
+
+def test_total_count_header_tracks_writes(monkeypatch):
+    """Test X-Total-Count comes from the maintained per-user counter and filtered counts"""
+    from app.database import User
+    from app.routes import calculation_routes
+
+    headers = get_auth_headers()
+    ids = [client.post("/calculations/", json={"operation": operation, "operand1": 4, "operand2": 2},
+                       headers=headers).json()["id"]
+           for operation in ("add", "add", "divide", "multiply")]
+    client.delete(f"/calculations/{ids[0]}", headers=headers)
+
+    response = client.get("/calculations/?limit=1", headers=headers)
+    assert len(response.json()) == 1
+    assert response.headers["X-Total-Count"] == "3"
+    response = client.get("/calculations/?operation=add", headers=headers)
+    assert response.headers["X-Total-Count"] == "1" and len(response.json()) == 1
+    response = client.get("/calculations/?operation=add&count=approximate", headers=headers)
+    assert response.headers["X-Total-Count"] == "1"
+    assert "X-Total-Count-Approximate" not in response.headers
+
+    client.delete("/calculations/", params={"operation": "divide"}, headers=headers)
+    assert client.get("/calculations/", headers=headers).headers["X-Total-Count"] == "2"
+    monkeypatch.setattr(calculation_routes, "TOTAL_COUNT_SAMPLE_SIZE", 2)
+    response = client.get("/calculations/?operation=multiply&count=approximate", headers=headers)
+    assert response.headers["X-Total-Count"] == "1"
+    assert response.headers["X-Total-Count-Approximate"] == "true"
+
+    db = TestingSessionLocal()
+    try:
+        assert db.query(User).filter(User.username == "testuser").one().calculation_count == 2
+    finally:
+        db.close()